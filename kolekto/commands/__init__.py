@@ -1,6 +1,8 @@
 import os
 
-from kolekto.db import MoviesMetadata
+from kolekto.db import MoviesMetadata, get_tree_hash_algorithm
+from kolekto.helpers import FileLock
+from kolekto.exceptions import KolektoRuntimeError
 
 
 class Command(object):
@@ -9,13 +11,20 @@ class Command(object):
     Base class for all commands.
 
     :cvar help: the help for the command
+    :cvar readonly: True if the command never writes the tree databases, in
+                    which case they are opened in reader mode without taking
+                    the tree lock, so the command can run while a writer is
+                    running (its reads are not isolated from the writes)
     """
 
     help = ''
+    readonly = False
 
     def __init__(self, name, profile, aparser_subs):
         self._aparser = aparser_subs.add_parser(name, help=self.help)
+        self._name = name
         self._profile = profile
+        self._tree_lock = None
         self._aparser.set_defaults(command=self.run, command_name=name)
 
     @property
@@ -42,6 +51,57 @@ class Command(object):
         """
         pass
 
-    def get_metadata_db(self, tree):
-        return MoviesMetadata(os.path.join(tree, '.kolekto', 'metadata.db'),
-                              object_class=self.profile.object_class)
\ No newline at end of file
+    def get_config_value(self, name, default=None):
+        """ Get a root value of the tree configuration, or the provided
+            default if the tree is not configured yet.
+        """
+        if self.profile.config is None:
+            return default
+        return self.profile.config.get(name)
+
+    def lock_tree(self, tree):
+        """ Take the writer lock of the tree, held until the end of the
+            command. Raise a KolektoRuntimeError on timeout.
+        """
+        if self._tree_lock is None:
+            lock = FileLock(os.path.join(tree, '.kolekto', 'lock'),
+                            timeout=self.get_config_value('db_lock_timeout'),
+                            owner=self._name)
+            lock.acquire()
+            self._tree_lock = lock
+
+    def get_hash_algorithm(self, tree):
+        """ Return the name of the hash algorithm of the tree, or raise a
+            KolektoRuntimeError if the tree must be rehashed to use the
+            configured one.
+        """
+        algorithm = get_tree_hash_algorithm(tree)
+        configured = self.get_config_value('hash_algorithm', algorithm)
+        if configured != algorithm:
+            raise KolektoRuntimeError('The tree is hashed using %s but hash_algorithm is set to %s, '
+                                      'run kolekto rehash' % (algorithm, configured))
+        return algorithm
+
+    def get_metadata_db(self, tree, backend=None):
+        """ Open the metadata database of the tree.
+
+        The tree is locked first if the command is not read-only.
+
+        :param backend: a (name, class) couple of the backend to use, default
+                        to the backend configured for the tree
+        """
+        if backend is None:
+            backend = self.get_config_value('db_backend', ('gdbm', MoviesMetadata))
+        _, backend_class = backend
+        filename = os.path.join(tree, '.kolekto', backend_class.filename)
+        if not os.path.exists(filename) and os.path.exists(filename + '.bak'):
+            raise KolektoRuntimeError('The metadata database has been converted to another '
+                                      'backend, set db_backend in the config to use it')
+        if self.readonly:
+            if not os.path.exists(filename):
+                raise KolektoRuntimeError('No metadata database found in %s' % tree)
+        else:
+            self.lock_tree(tree)
+        return backend_class(filename, object_class=self.profile.object_class,
+                             sync_interval=self.get_config_value('db_sync_interval'),
+                             readonly=self.readonly)
\ No newline at end of file
@@ -0,0 +1,34 @@
+from kolekto.printer import printer
+from kolekto.commands import Command
+from kolekto.commands.stats import humanize_filesize
+from kolekto.db import iter_tree_databases, needs_compaction
+
+
+class Compact(Command):
+
+    """ Report the fragmentation of the tree databases and compact them.
+    """
+
+    help = 'compact the databases of the tree'
+
+    def prepare(self):
+        self.add_arg('--report', '-r', action='store_true', default=False,
+                     help='Only report the fragmentation of databases')
+        self.add_arg('--auto', action='store_true', default=False,
+                     help='Only compact databases whose fragmentation exceeds '
+                          'the db_autocompact threshold')
+
+    def run(self, args, config):
+        self.lock_tree(args.tree)
+        threshold = self.get_config_value('db_autocompact')
+        for name, db in iter_tree_databases(args.tree):
+            live, size = db.size_report()
+            printer.p('<b>{name}</b>: {live} of live data in {size} ({wasted}% wasted)',
+                      name=name, live=humanize_filesize(live), size=humanize_filesize(size),
+                      wasted=100 * (size - live) / size if size else 0)
+            if args.report or (args.auto and not needs_compaction(live, size, threshold)):
+                db.close()
+                continue
+            db.compact()
+            printer.p('  compacted to {size}', size=humanize_filesize(db.size_report()[1]))
+            db.close()
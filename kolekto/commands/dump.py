@@ -1,17 +1,83 @@
+import gzip
 import json
+from datetime import datetime
 
 from kolekto.printer import printer
 from kolekto.commands import Command
 
 
+def parse_since(value):
+    """ Parse a change sequence number or a date (YYYY-MM-DD).
+    """
+    if value.isdigit():
+        return int(value)
+    else:
+        return datetime.strptime(value, '%Y-%m-%d')
+
+
 class Dump(Command):
 
     """ Dump the whole database into json.
+
+    Records are written while the database is read, so the memory usage
+    doesn't depend on the size of the collection.
     """
 
     help = 'dump database into json'
+    readonly = True
+
+    def prepare(self):
+        self.add_arg('--format', choices=('json', 'jsonl'), default='json',
+                     help='Dump as a json list (default) or as one json '
+                          'record per line')
+        self.add_arg('--gzip', '-z', action='store_true', default=False,
+                     help='Compress the dump using gzip')
+        self.add_arg('--fields', type=lambda x: x.split(','), default=None,
+                     help='Comma separated list of fields to dump (eg: title,year)')
+        self.add_arg('--since', type=parse_since, default=None,
+                     help='Only dump movies changed after this change sequence '
+                          'number (0 dumps all movies with their sequence) or '
+                          'imported since this date (YYYY-MM-DD)')
+
+    def _records(self, mdb, since):
+        """ Iterate over the records to dump.
+        """
+        if since is None:
+            for movie_hash, movie in mdb.itermovies():
+                yield {'hash': movie_hash, 'movie': movie}
+        elif isinstance(since, datetime):
+            for movie_hash, movie in mdb.iterimported(since):
+                yield {'hash': movie_hash, 'movie': movie}
+        else:
+            last_seq = mdb.changes.last_seq
+            for seq, movie_hash, movie in mdb.iterchanges(since):
+                if movie is None:
+                    yield {'hash': movie_hash, 'seq': seq, 'deleted': True}
+                else:
+                    yield {'hash': movie_hash, 'seq': seq, 'movie': movie}
+            printer.p('Dumped changes up to sequence {seq}', seq=last_seq, err=True)
 
     def run(self, args, config):
         mdb = self.get_metadata_db(args.tree)
-        dump = [{'hash': x, 'movie': y} for x, y in mdb.itermovies()]
-        json.dump(dump, printer.output)
\ No newline at end of file
+
+        if args.gzip:
+            output = gzip.GzipFile(fileobj=printer.output, mode='wb')
+        else:
+            output = printer.output
+
+        if args.format == 'json':
+            output.write('[')
+        for i, record in enumerate(self._records(mdb, args.since)):
+            if args.fields is not None and 'movie' in record:
+                record['movie'] = dict((x, record['movie'][x]) for x in args.fields
+                                       if x in record['movie'])
+            if i and args.format == 'json':
+                output.write(', ')
+            output.write(json.dumps(record))
+            if args.format == 'jsonl':
+                output.write('\n')
+        if args.format == 'json':
+            output.write(']')
+
+        if args.gzip:
+            output.close()  # Doesn't close the underlying output
@@ -11,12 +11,14 @@ class FindDuplicates(Command):
     """
 
     help = 'find duplicate movies in collection'
+    readonly = True
 
     def run(self, args, config):
-        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class)
+        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class,
+                              readonly=self.readonly)
         mdb = self.get_metadata_db(args.tree)
         hash_by_title = defaultdict(lambda: [])
-        for movie_hash, movie in mdb.itermovies():
+        for movie_hash, movie in mdb.iterduplicates(('title', 'year')):
             movie = mds.attach(movie_hash, movie)
             hash_info = '<inv> %s </inv> (%s/%s)' % (movie_hash, movie.get('quality'), movie.get('ext'))
             hash_by_title[movie.get('title', None), movie.get('year', None)].append(hash_info)
@@ -16,29 +16,30 @@ class FlagCommand(Command):
     def run(self, args, config):
         mdb = self.get_metadata_db(args.tree)
 
-        for movie_input in args.input:
-            movie_hash = get_hash(movie_input)
-
-            try:
-                movie = mdb.get(movie_hash)
-            except KeyError:
-                printer.p('Unknown movie hash.')
-                return
-            if args.unflag:
-                for flag in self.unflag_unset_flags:
-                    try:
-                        del movie[flag]
-                    except KeyError:
-                        pass
-            else:
-                for flag in self.flags:
-                    movie[flag] = True
-                for flag in self.unset_flags:
-                    try:
-                        del movie[flag]
-                    except KeyError:
-                        pass
-            mdb.save(movie_hash, movie)
+        with mdb.transaction():
+            for movie_input in args.input:
+                movie_hash = get_hash(movie_input)
+
+                try:
+                    movie = mdb.get(movie_hash)
+                except KeyError:
+                    printer.p('Unknown movie hash.')
+                    return
+                if args.unflag:
+                    for flag in self.unflag_unset_flags:
+                        try:
+                            del movie[flag]
+                        except KeyError:
+                            pass
+                else:
+                    for flag in self.flags:
+                        movie[flag] = True
+                    for flag in self.unset_flags:
+                        try:
+                            del movie[flag]
+                        except KeyError:
+                            pass
+                mdb.save(movie_hash, movie)
 
 
 class Watch(FlagCommand):
@@ -2,11 +2,15 @@ import os
 
 from kolekto.printer import printer
 from kolekto.commands import Command
+from kolekto.commands.stats import humanize_filesize
+from kolekto.db import ImportJournal, iter_tree_databases, needs_compaction
 
 
 class Gc(Command):
 
-    """ Garbage collect orphan files stored in tree.
+    """ Garbage collect orphan files stored in tree and stale partial imports,
+        and compact the databases whose fragmentation exceeds the
+        db_autocompact threshold.
     """
 
     help = 'garbage collect orphan files'
@@ -20,7 +24,8 @@ class Gc(Command):
         printer.verbose('Found {nb} files in database', nb=len(db_files))
         fs_files = set(os.listdir(os.path.join(args.tree, '.kolekto', 'movies')))
         printer.verbose('Found {nb} files in filesystem', nb=len(fs_files))
-        orphan_files = fs_files - db_files
+        partial_files = self._collect_partial_imports(args.tree)
+        orphan_files = fs_files - db_files - partial_files
         printer.p('Found {nb} orphan files to delete', nb=len(orphan_files))
         if orphan_files:
             printer.verbose('Files to delete: {files}', files=', '.join(orphan_files))
@@ -31,4 +36,39 @@ class Gc(Command):
                     except OSError as err:
                         printer.p('Unable to delete {file}: {err}', file=orphan_file, err=err)
                     else:
-                        printer.verbose('Deleted {file}', file=orphan_file)
\ No newline at end of file
+                        printer.verbose('Deleted {file}', file=orphan_file)
+
+        # Compact the fragmented databases:
+        mdb.close()
+        threshold = self.get_config_value('db_autocompact')
+        for name, db in iter_tree_databases(args.tree):
+            live, size = db.size_report()
+            if needs_compaction(live, size, threshold):
+                printer.p('Compacting {name}...', name=name)
+                db.compact()
+            db.close()
+
+    def _collect_partial_imports(self, tree):
+        """ Forget the partial imports which can't be resumed anymore (their
+            partial file is left to the orphans collection), propose to delete
+            the others and return the set of partial files to keep.
+        """
+        journal = ImportJournal(os.path.join(tree, '.kolekto', ImportJournal.filename))
+        resumable = {}
+        for source_filename, record in list(journal.iterpartials()):
+            if journal.is_resumable(source_filename, record):
+                resumable[source_filename] = record
+            else:
+                printer.verbose('Forgetting stale partial import of {file}', file=source_filename)
+                journal.end(source_filename)
+        if resumable:
+            printer.p('Found {nb} interrupted imports which can be resumed:', nb=len(resumable))
+            for source_filename, record in resumable.iteritems():
+                printer.p(' - {file} ({copied} copied)', file=source_filename,
+                          copied=humanize_filesize(record['copied']))
+            if printer.ask('Would you like to delete them?', default=False):
+                for source_filename in resumable:
+                    journal.end(source_filename)
+                resumable = {}
+        journal.close()
+        return set(record['partial'] for record in resumable.itervalues())
@@ -2,15 +2,23 @@ import re
 import os
 import json
 import datetime
-from hashlib import sha1
+import threading
+from contextlib import contextmanager
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from itertools import islice
 from tempfile import NamedTemporaryFile
 
 from kolekto.printer import printer, option
 from kolekto.commands import Command
 from kolekto.commands.show import show
+from kolekto.commands.stats import humanize_filesize
 from kolekto.datasources import MovieDatasource
 from kolekto.exceptions import KolektoRuntimeError
-from kolekto.db import AttachmentStore
+from kolekto.helpers import WAIT_FOREVER
+from kolekto.db import AttachmentStore, HashCache, SampleIndex, ImportJournal, IMPORT_DATE_FORMAT
+from kolekto.fastcopy import (copy_file, hash_file, hash_prefix, sample_fingerprint,
+                              DEFAULT_BUFFER_SIZE, HASH_ALGORITHMS)
 
 
 def clean_title(title):
@@ -33,56 +41,132 @@ def clean_title_series(title):
         return match.group(1), int(match.group(2)), int(match.group(3))
 
 
-def copy(tree, source_filename):
+# Serialize the check and the move of files into the tree of concurrent imports:
+_store_lock = threading.Lock()
+
+
+@contextmanager
+def _progress(filename, enabled=True):
+    """ Show a progress bar for the processing of the file if enabled, and
+        yield the update callback (None if disabled).
+    """
+    if enabled:
+        with printer.progress(os.path.getsize(filename)) as update:
+            yield update
+    else:
+        yield None
+
+
+def _check_not_stored(tree, filehash):
+    """ Raise an IOError if a file with this hash already exists in tree.
+    """
+    if os.path.exists(os.path.join(tree, '.kolekto', 'movies', filehash)):
+        raise IOError('This file already exists in tree (%s)' % filehash)
+
+
+def _full_hash(source_filename, buffer_size=DEFAULT_BUFFER_SIZE, progress=True, hash_cache=None,
+               algorithm='sha1'):
+    """ Hash the file (or get its hash from the cache) and return it.
+    """
+    def compute():
+        with _progress(source_filename, progress) as update:
+            return hash_file(source_filename, buffer_size, update=update,
+                             hash_factory=HASH_ALGORITHMS[algorithm])
+    if hash_cache is not None:
+        return hash_cache.hash(source_filename, compute, algorithm)
+    else:
+        return compute()
+
+
+def copy(tree, source_filename, buffer_size=DEFAULT_BUFFER_SIZE, progress=True, hash_cache=None,
+         sample_index=None, journal=None, algorithm='sha1'):
     """ Copy file in tree, show a progress bar during operations,
-        and return the sha1 sum of copied file.
+        and return the hash of copied file (using the named algorithm).
+
+    If a :class:`HashCache` is provided, the copy is aborted before starting
+    if the hash of the file is cached and the file already exists in tree.
+    If a :class:`SampleIndex` is provided, the file is first compared with
+    the stored files of the same size and sampled fingerprint, and only
+    hashed before the copy if one of them matches. If an
+    :class:`ImportJournal` is provided, the progress of the copy is journaled
+    and an interrupted copy of the same file is resumed.
     """
     #_, ext = os.path.splitext(source_filename)
-    filehash = sha1()
-    with printer.progress(os.path.getsize(source_filename)) as update:
-        with open(source_filename, 'rb') as fsource:
-            with NamedTemporaryFile(dir=os.path.join(tree, '.kolekto', 'movies'), delete=False) as fdestination:
-                # Copy the source into the temporary destination:
-                while True:
-                    buf = fsource.read(10 * 1024)
-                    if not buf:
-                        break
-                    filehash.update(buf)
-                    fdestination.write(buf)
-                    update(len(buf))
-                # Rename the file to its final name or raise an error if
-                # the file already exists:
-                dest = os.path.join(tree, '.kolekto', 'movies', filehash.hexdigest())
-                if os.path.exists(dest):
-                    raise IOError('This file already exists in tree (%s)' % filehash.hexdigest())
-                else:
-                    os.rename(fdestination.name, dest)
-    return filehash.hexdigest()
-
-
-def link(tree, source_filename, symlink=False):
-    filehash = sha1()
-    with printer.progress(os.path.getsize(source_filename)) as update:
-        with open(source_filename, 'rb') as fsource:
-                # Copy the source into the temporary destination:
-                while True:
-                    buf = fsource.read(10 * 1024)
-                    if not buf:
-                        break
-                    filehash.update(buf)
-                    update(len(buf))
-                # Hardlink the file or raise an error if the file already exists:
-                dest = os.path.join(tree, '.kolekto', 'movies', filehash.hexdigest())
-                if os.path.exists(dest):
-                    raise IOError('This file already exists in tree (%s)' % filehash.hexdigest())
-                else:
-                    if symlink:
-                        source_filename = os.path.relpath(source_filename,
-                                                          os.path.join(tree, '.kolekto', 'movies'))
-                        os.symlink(source_filename, dest)
-                    else:
-                        os.link(source_filename, dest)
-    return filehash.hexdigest()
+    if hash_cache is not None:
+        filehash = hash_cache.lookup(source_filename, algorithm)
+        if filehash is not None:
+            _check_not_stored(tree, filehash)
+    size = os.path.getsize(source_filename)
+    if sample_index is not None:
+        sample = sample_fingerprint(source_filename)
+        candidates = sample_index.candidates(size, sample)
+        if candidates:
+            printer.verbose('Found {nb} possible duplicate(s) in tree, hashing the file...',
+                            nb=len(candidates))
+            filehash = _full_hash(source_filename, buffer_size, progress, hash_cache, algorithm)
+            if filehash in candidates:
+                _check_not_stored(tree, filehash)
+    fingerprint = HashCache.fingerprint(source_filename)
+    movies_directory = os.path.join(tree, '.kolekto', 'movies')
+    resume = journal.resumable(source_filename) if journal is not None else None
+    if resume is not None:
+        partial_filename, start = resume
+        printer.p('Resuming the interrupted copy at {size}', size=humanize_filesize(start))
+        fdestination = open(partial_filename, 'r+b')
+        fdestination.truncate(start)
+        hash_object = hash_prefix(partial_filename, start, buffer_size, HASH_ALGORITHMS[algorithm])
+    else:
+        fdestination = NamedTemporaryFile(dir=movies_directory, prefix='partial-', delete=False)
+        start, hash_object = 0, None
+        if journal is not None:
+            journal.begin(source_filename, fdestination.name)
+    if journal is not None:
+        checkpoint = lambda copied: journal.checkpoint(source_filename, copied)
+    else:
+        checkpoint = None
+    with _progress(source_filename, progress) as update:
+        with fdestination:
+            if start and update is not None:
+                update(start)
+            # Copy the source into the temporary destination:
+            filehash = copy_file(source_filename, fdestination, buffer_size, update=update,
+                                 hash_factory=HASH_ALGORITHMS[algorithm], start=start,
+                                 hash_object=hash_object, checkpoint=checkpoint)
+        # Rename the file to its final name or raise an error if
+        # the file already exists:
+        dest = os.path.join(movies_directory, filehash)
+        try:
+            with _store_lock:
+                _check_not_stored(tree, filehash)
+                os.rename(fdestination.name, dest)
+        except IOError:
+            os.remove(fdestination.name)
+            raise
+        finally:
+            if journal is not None:
+                journal.end(source_filename)
+    if hash_cache is not None:
+        hash_cache.store(source_filename, filehash, algorithm, fingerprint)
+        hash_cache.store(dest, filehash, algorithm)
+    if sample_index is not None:
+        sample_index.add(filehash, size, sample)
+    return filehash
+
+
+def link(tree, source_filename, symlink=False, buffer_size=DEFAULT_BUFFER_SIZE, progress=True,
+         hash_cache=None, sample_index=None, algorithm='sha1'):
+    filehash = _full_hash(source_filename, buffer_size, progress, hash_cache, algorithm)
+    # Hardlink the file or raise an error if the file already exists:
+    dest = os.path.join(tree, '.kolekto', 'movies', filehash)
+    with _store_lock:
+        _check_not_stored(tree, filehash)
+        if symlink:
+            os.symlink(os.path.relpath(source_filename, os.path.join(tree, '.kolekto', 'movies')), dest)
+        else:
+            os.link(source_filename, dest)
+    if sample_index is not None:
+        sample_index.add(filehash, os.path.getsize(source_filename), sample_fingerprint(source_filename))
+    return filehash
 
 
 def list_attachments(fullname):
@@ -118,6 +202,12 @@ class BaseImport(Command):
         self.add_arg('--dont-import-attachments', dest='import_attachments',
                      action='store_false', default=True,
                      help='Don\'t import the attachments')
+        self.add_arg('--jobs', '-j', type=int, default=1,
+                     help='Number of files to copy or hash and of datasource '
+                          'lookups to run concurrently')
+        self.add_arg('--prefetch', type=int, default=2,
+                     help='Number of next files to search in datasources while '
+                          'prompting for the current one (0 to disable)')
 
     def run(self, args, config):
         # Check the args:
@@ -125,60 +215,222 @@ class BaseImport(Command):
             raise KolektoRuntimeError('--delete can\'t be used with --symlink')
         elif args.symlink and args.hardlink:
             raise KolektoRuntimeError('--symlink and --hardlink are mutually exclusive')
+        elif args.jobs < 1:
+            raise KolektoRuntimeError('--jobs must be at least 1')
+        elif args.prefetch < 0:
+            raise KolektoRuntimeError('--prefetch can\'t be negative')
 
         # Load the metadata database:
         mdb = self.get_metadata_db(args.tree)
 
         # Load informations from db:
-        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class)
+        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class,
+                              readonly=self.readonly)
+
+        self._attachment_store = AttachmentStore(os.path.join(args.tree, '.kolekto', 'attachments'))
+        self._buffer_size = self.get_config_value('copy_buffer_size', DEFAULT_BUFFER_SIZE)
+        self._hash_algorithm = self.get_hash_algorithm(args.tree)
+        self._hash_cache = HashCache(os.path.join(args.tree, '.kolekto', HashCache.filename))
+        self._sample_index = SampleIndex(os.path.join(args.tree, '.kolekto', SampleIndex.filename))
+        self._journal = ImportJournal(os.path.join(args.tree, '.kolekto', ImportJournal.filename))
+        added, discarded = self._sample_index.update_from(os.path.join(args.tree, '.kolekto', 'movies'))
+        printer.debug('Sample index updated: {added} file(s) added, {discarded} discarded',
+                      added=added, discarded=discarded)
+
+        files = [x.decode('utf8') for x in args.file]
+        self._failed = 0
+        self._prefetched = {}
+        self._prefetcher = ThreadPool(args.prefetch) if args.prefetch else None
+        try:
+            if args.jobs > 1:
+                self._run_concurrently(mdb, mds, args, config, files)
+            else:
+                self._run_serially(mdb, mds, args, config, files)
+        finally:
+            if self._prefetcher is not None:
+                self._prefetcher.terminate()
+        if self._failed:
+            printer.p('Unable to import {nb} file(s).', nb=self._failed)
+
+    def _run_serially(self, mdb, mds, args, config, files):
+        """ Import the files one by one, the file of each confirmed movie
+            being stored in the tree by a background worker while the user
+            is prompted for the next files.
+
+        Movies are saved in the database once their file is stored, in the
+        order of the files on the command line.
+        """
+        worker = ThreadPool(1)
+        try:
+            pending = deque()
+            for index, filename in enumerate(files):
+                self._prefetch(mds, args, files, index)
+                movie = self._import(mdb, mds, args, config, filename)
+                if movie is not None:
+                    # Refresh the full data for the choosen movie:
+                    movie = mds.refresh(movie)
+                    movie, attachments = self._review(args, filename, movie)
+                    store = worker.apply_async(self._store, (args, filename, False))
+                    pending.append((filename, movie, attachments, store))
+                while pending and pending[0][3].ready():
+                    self._complete(mdb, args, *pending.popleft())
+            if pending:
+                printer.p('Waiting for {nb} file(s) to be stored in the tree...', nb=len(pending))
+            while pending:
+                self._complete(mdb, args, *pending.popleft())
+        finally:
+            worker.terminate()
+
+    def _prefetch(self, mds, args, files, index):
+        """ Start the search of the files from index to index + prefetch in
+            background, using the query guessed from their filename.
+        """
+        if self._prefetcher is None:
+            return
+        for filename in files[index:index + args.prefetch + 1]:
+            query, kwargs = self._default_query(args, filename)
+            key = (query, tuple(sorted(kwargs.items())))
+            if key not in self._prefetched:
+                # Only the first result is used in auto mode:
+                limit = 1 if args.auto else None
+                search = lambda query, kwargs: list(islice(mds.search(query, **kwargs), limit))
+                self._prefetched[key] = self._prefetcher.apply_async(search, (query, kwargs))
+
+    def _search_results(self, mds, query, **kwargs):
+        """ Return the (datasource, movie) results of the search, prefetched
+            if the query is the one guessed from the filename.
+        """
+        prefetched = self._prefetched.pop((query, tuple(sorted(kwargs.items()))), None)
+        if prefetched is not None:
+            return prefetched.get(WAIT_FOREVER)
+        else:
+            return mds.search(query, **kwargs)
+
+    def _default_query(self, args, filename):
+        """ Return the (title, search kwargs) guessed from the filename,
+            used as default search of the file.
+        """
+        raise NotImplementedError()
 
-        attachment_store = AttachmentStore(os.path.join(args.tree, '.kolekto', 'attachments'))
+    def _run_concurrently(self, mdb, mds, args, config, files):
+        """ Import the files using a pool of threads for datasource lookups
+            and another for copies and hashes.
 
-        for filename in args.file:
-            filename = filename.decode('utf8')
+        The user is prompted in the main thread, and movies are saved in the
+        database in the order of the files on the command line.
+        """
+        lookups = ThreadPool(args.jobs)
+        workers = ThreadPool(args.jobs)
+        try:
+            pending = []
+            for index, filename in enumerate(files):
+                if args.auto:
+                    movie = None  # Searched in the lookup thread
+                else:
+                    self._prefetch(mds, args, files, index)
+                    movie = self._import(mdb, mds, args, config, filename)
+                    if movie is None:
+                        continue
+                lookup = lookups.apply_async(self._lookup, (mdb, mds, args, config,
+                                                            filename, movie, workers))
+                pending.append((filename, lookup))
+            for filename, lookup in pending:
+                try:
+                    movie, store = lookup.get(WAIT_FOREVER)
+                except KolektoRuntimeError as err:
+                    self._report_failure(filename, err)
+                    continue
+                if movie is not None:
+                    movie, attachments = self._review(args, filename, movie)
+                    self._complete(mdb, args, filename, movie, attachments, store)
+        finally:
+            lookups.terminate()
+            workers.terminate()
+
+    def _lookup(self, mdb, mds, args, config, filename, movie, workers):
+        """ Search the movie of the file if not provided (auto mode only),
+            refresh it and queue the file to be stored in the tree.
+
+        :return: a (movie, AsyncResult of the store) couple, or (None, None)
+                 if no movie was found
+        """
+        if movie is None:
             movie = self._import(mdb, mds, args, config, filename)
+            if movie is None:
+                return None, None
+        movie = mds.refresh(movie)
+        return movie, workers.apply_async(self._store, (args, filename, False))
 
-            # Refresh the full data for the choosen movie:
-            movie = mds.refresh(movie)
+    def _store(self, args, filename, progress=True):
+        """ Hardlink or copy the movie in the tree and return its hash.
+        """
+        if args.hardlink or args.symlink:
+            if progress:
+                printer.p('\nComputing movie hash...')
+            return link(args.tree, filename, args.symlink, self._buffer_size, progress,
+                        self._hash_cache, self._sample_index, self._hash_algorithm)
+        else:
+            if progress:
+                printer.p('\nCopying movie in kolekto tree...')
+            return copy(args.tree, filename, self._buffer_size, progress,
+                        self._hash_cache, self._sample_index, self._journal, self._hash_algorithm)
 
-            # Append the import date
-            movie['import_date'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+    def _review(self, args, filename, movie):
+        """ Let the user review the movie and choose the attachments to
+            import, return the (movie, attachments) couple.
+        """
+        # Append the import date
+        movie['import_date'] = datetime.datetime.now().strftime(IMPORT_DATE_FORMAT)
 
-            if args.show:
-                show(movie)
-                printer.p('')
+        if args.show:
+            show(movie)
+            printer.p('')
 
-            # Edit available data:
-            if not args.auto and printer.ask('Do you want to edit the movie metadata', default=False):
-                movie = self.profile.object_class(json.loads(printer.edit(json.dumps(movie, indent=True))))
+        # Edit available data:
+        if not args.auto and printer.ask('Do you want to edit the movie metadata', default=False):
+            movie = self.profile.object_class(json.loads(printer.edit(json.dumps(movie, indent=True))))
+
+        attachments = []
+        if args.import_attachments:
+            attachments = list_attachments(filename)
+            if attachments:
+                printer.p('Found {nb} attachment(s) for this movie:', nb=len(attachments))
+                for attach in attachments:
+                    printer.p(' - {filename}', filename=attach)
+                if not args.auto and not printer.ask('Import them?', default=True):
+                    attachments = []
+        return movie, attachments
+
+    def _report_failure(self, filename, err):
+        printer.p('Error: unable to import {filename}: {error}', filename=filename, error=err)
+        self._failed += 1
+
+    def _complete(self, mdb, args, filename, movie, attachments, store):
+        """ Wait for the file to be stored in the tree (store is the
+            AsyncResult of :meth:`_store`), then save the movie to the
+            database and import its attachments.
+
+        A failure to store the file (eg: already in the tree) is reported
+        and the file skipped, so the import of the other files goes on.
+        """
+        try:
+            movie_hash = store.get(WAIT_FOREVER)
+        except (EnvironmentError, KolektoRuntimeError) as err:
+            self._report_failure(filename, err)
+            return
 
-            # Hardlink or copy the movie in the tree
-            if args.hardlink or args.symlink:
-                printer.p('\nComputing movie sha1sum...')
-                movie_hash = link(args.tree, filename, args.symlink)
-            else:
-                printer.p('\nCopying movie in kolekto tree...')
-                movie_hash = copy(args.tree, filename)
-            printer.p('')
+        mdb.save(movie_hash, movie)
+        printer.verbose('Imported {filename} as {hash}', filename=filename, hash=movie_hash)
+
+        if args.delete:
+            os.unlink(filename)
+            printer.debug('Deleted original file {filename}', filename=filename)
 
-            mdb.save(movie_hash, movie)
-            printer.debug('Movie {hash} saved to the database', hash=movie_hash)
-
-            if args.delete:
-                os.unlink(filename)
-                printer.debug('Deleted original file {filename}', filename=filename)
-
-            # Import the attachments
-            if movie_hash is not None and args.import_attachments:
-                attachments = list_attachments(filename)
-                if attachments:
-                    printer.p('Found {nb} attachment(s) for this movie:', nb=len(attachments))
-                    for attach in attachments:
-                        printer.p(' - {filename}', filename=attach)
-                    if not args.auto and printer.ask('Import them?', default=True):
-                        for attach in attachments:
-                            _, ext = os.path.splitext(attach)
-                            attachment_store.store(movie_hash, ext.lstrip('.'), open(attach))
+        # Import the attachments
+        if movie_hash is not None:
+            for attach in attachments:
+                _, ext = os.path.splitext(attach)
+                self._attachment_store.store(movie_hash, ext.lstrip('.'), open(attach))
 
     def _import(self):
         raise NotImplementedError()
@@ -191,6 +443,12 @@ class ImportMovies(BaseImport):
 
     help = 'import a movie'
 
+    def _default_query(self, args, filename):
+        title, _ = os.path.splitext(os.path.basename(filename))
+        year, title = clean_title(title)
+        # Disable the year filter if auto mode is disabled:
+        return title, {'year': year if args.auto else None}
+
     def _import(self, mdb, mds, args, config, filename):
         printer.debug('Importing file {filename}', filename=filename)
         short_filename = os.path.basename(filename)
@@ -226,7 +484,7 @@ class ImportMovies(BaseImport):
         If auto is enabled, directly returns the first movie found.
         """
         choices = []
-        for datasource, movie in mdb.search(query, year=year):
+        for datasource, movie in self._search_results(mdb, query, year=year):
             if auto:
                 return datasource, movie
             if movie.get('directors'):
@@ -261,6 +519,11 @@ class ImportTvSeries(BaseImport):
 
     help = 'import a tv series episode'
 
+    def _default_query(self, args, filename):
+        title, _ = os.path.splitext(os.path.basename(filename))
+        title, season_num, episode_num = clean_title_series(title)
+        return title, {'season': season_num, 'episode': episode_num}
+
     def _import(self, mdb, mds, args, config, filename):
         printer.debug('Importing file {filename}', filename=filename)
         short_filename = os.path.basename(filename)
@@ -297,7 +560,7 @@ class ImportTvSeries(BaseImport):
         If auto is enabled, directly returns the first movie found.
         """
         choices = []
-        for datasource, movie in mdb.search(query, season=season_num, episode=episode_num):
+        for datasource, movie in self._search_results(mdb, query, season=season_num, episode=episode_num):
             if auto:
                 return datasource, movie
             fmt = u'<b>{title}</b> - <b>{ep}</b> S{season:02d}E{episode:02d} [{datasource}]'
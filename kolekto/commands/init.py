@@ -5,6 +5,7 @@ import pkg_resources
 from kolekto.printer import printer
 from kolekto.commands import Command
 from kolekto.exceptions import KolektoRuntimeError
+from kolekto.db import set_tree_hash_algorithm
 
 
 DEFAULT_CONFIG = '''
@@ -67,6 +68,7 @@ class Init(Command):
         # Write the default config:
         with open(os.path.join(args.tree, '.kolekto', 'config'), 'w') as fconfig:
             fconfig.write(DEFAULT_CONFIG.format(profile=args.profile))
+        set_tree_hash_algorithm(args.tree, 'sha1')
         printer.p('Initialized empty Kolekto tree in {where}.', where=os.path.abspath(args.tree))
 
         # Open the metadata db to create it automatically:
@@ -64,6 +64,7 @@ class Link(Command):
     """
 
     help = 'create symlinks'
+    readonly = True
 
     def prepare(self):
         self.add_arg('--dry-run', '-d', action='store_true', default=False,
@@ -71,7 +72,8 @@ class Link(Command):
 
     def run(self, args, config):
         mdb = self.get_metadata_db(args.tree)
-        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class)
+        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class,
+                              readonly=self.readonly)
 
         if args.dry_run:
             printer.p('Dry run: I will not create or delete any link')
@@ -3,6 +3,7 @@ from kolekto.printer import printer
 from kolekto.exceptions import KolektoRuntimeError
 from kolekto.pattern import parse_pattern
 from kolekto.datasources import MovieDatasource
+from kolekto.db import order_key
 
 
 class ListingFormatWrapper(object):
@@ -38,9 +39,14 @@ class List(Command):
     """
 
     help = 'list movies'
+    readonly = True
 
     def prepare(self):
         self.add_arg('listing', metavar='listing', default='default', nargs='?')
+        self.add_arg('--facet', '-f', nargs=2, metavar=('FACET', 'VALUE'),
+                     action='append', default=[],
+                     help='Only list movies having this value in the facet '
+                          '(eg: -f directors "Colin Levy")')
 
     def _config(self, args, config):
         """ Get configuration for the current used listing.
@@ -59,11 +65,14 @@ class List(Command):
 
     def run(self, args, config):
         mdb = self.get_metadata_db(args.tree)
-        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class)
+        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class,
+                              readonly=self.readonly)
         listing = self._config(args, config)
-        def _sorter((movie_hash, movie)):
-            return tuple(movie.get(x) for x in listing['order'])
-        movies = sorted(mdb.itermovies(), key=_sorter)
+        if args.facet:
+            facets = [(facet, value.decode('utf8')) for facet, value in args.facet]
+            movies = sorted(mdb.itermatching(facets), key=order_key(listing['order']))
+        else:
+            movies = mdb.itermovies(order=listing['order'])
         # Get the current used listing:
         for movie_hash, movie in movies:
             movie = mds.attach(movie_hash, movie)
@@ -0,0 +1,94 @@
+import os
+
+from kolekto.printer import printer
+from kolekto.commands import Command
+from kolekto.exceptions import KolektoRuntimeError
+from kolekto.db import get_db_backends, TREE_DATABASES
+from kolekto.helpers import JsonDbm
+
+
+# Files SQLite may create next to a database:
+SQLITE_SIDECARS = ('-wal', '-shm', '-journal')
+
+
+def move_database(filename, destination):
+    """ Move (or remove if destination is None) a closed database with its
+        SQLite sidecar files.
+    """
+    for suffix in ('',) + SQLITE_SIDECARS:
+        if os.path.exists(filename + suffix):
+            if destination is None:
+                os.remove(filename + suffix)
+            else:
+                os.rename(filename + suffix, destination + suffix)
+
+
+class MigrateDb(Command):
+
+    """ Convert the metadata database to another storage backend, or
+        re-encode the databases of the tree with the configured codec.
+
+    Once converted, the source database is kept under a .bak name, so the
+    database can be converted back.
+    """
+
+    help = 'convert the metadata database to another backend or codec'
+
+    def prepare(self):
+        self.add_arg('backend', choices=sorted(get_db_backends()), nargs='?',
+                     help='The backend to convert the database to')
+        self.add_arg('--recode', action='store_true', default=False,
+                     help='Rewrite the records using the codec set in db_codec')
+
+    def run(self, args, config):
+        if args.backend is None and not args.recode:
+            raise KolektoRuntimeError('Nothing to do, give a backend and/or --recode')
+        self.lock_tree(args.tree)
+        if args.backend is not None:
+            self._convert(args)
+        if args.recode:
+            self._recode(args)
+
+    def _convert(self, args):
+        source_name, source_class = self.get_config_value('db_backend')
+        if args.backend == source_name:
+            raise KolektoRuntimeError('The database already use the %s backend' % source_name)
+        target = (args.backend, get_db_backends()[args.backend])
+        target_filename = os.path.join(args.tree, '.kolekto', target[1].filename)
+        if os.path.exists(target_filename):
+            raise KolektoRuntimeError('A database already exists in %s' % target_filename)
+
+        source_db = self.get_metadata_db(args.tree)
+        source_filename = os.path.join(args.tree, '.kolekto', source_class.filename)
+
+        # Write the converted database under a temporary name and rename it
+        # once completed and closed (SQLite commits may be in its WAL journal
+        # until then), so an interrupted migration is not mistaken for a
+        # complete database:
+        partial_filename = target_filename + '.partial'
+        move_database(partial_filename, None)
+        partial_db = target[1](partial_filename, object_class=self.profile.object_class,
+                               indexes=False)  # Indexes are shared with the source
+        with printer.progress(source_db.count(), task=True) as update, partial_db.transaction():
+            for movie_hash, movie in source_db.itermovies():
+                partial_db.save(movie_hash, movie)
+                update(1)
+        count = partial_db.count()
+        partial_db.close()
+        source_db.close()
+        move_database(partial_filename, target_filename)
+        move_database(source_filename, source_filename + '.bak')
+
+        printer.p('Converted {nb} movies to the {backend} backend, the previous database '
+                  'is kept in {bak}.', nb=count, backend=args.backend, bak=source_filename + '.bak')
+        printer.p("Set db_backend = '{backend}' in the config to use it.", backend=args.backend)
+
+    def _recode(self, args):
+        codec = self.get_config_value('db_codec')
+        for name in TREE_DATABASES:
+            filename = os.path.join(args.tree, '.kolekto', name)
+            if not os.path.exists(filename):
+                continue
+            rewritten = JsonDbm(filename, object_class=lambda x: x, codec=codec).recode()
+            printer.p('Rewritten {nb} records of {name} using the {codec} codec.',
+                      nb=rewritten, name=name, codec=codec)
@@ -1,13 +1,48 @@
+import re
+import copy
+import argparse
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
 from kolekto.printer import printer
 from kolekto.commands import Command
-from kolekto.datasources import MovieDatasource
+from kolekto.datasources import (MovieDatasource, get_refresh_date,
+                                 REFRESH_DATE_FIELD, REFRESH_DATASOURCES_FIELD)
 from kolekto.commands.show import show
-from kolekto.helpers import get_hash
+from kolekto.exceptions import KolektoRuntimeError
+from kolekto.helpers import get_hash, WAIT_FOREVER
+from kolekto.db import IMPORT_DATE_FORMAT
+
+
+AGE_RE = re.compile(r'^(\d+)([smhdw])$')
+AGE_UNITS = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+REFRESH_FIELDS = (REFRESH_DATE_FIELD, REFRESH_DATASOURCES_FIELD)
+
+
+def parse_age(value):
+    """ Parse an age such as 30d (units are s, m, h, d and w).
+    """
+    match = AGE_RE.match(value)
+    if match is None:
+        raise argparse.ArgumentTypeError('bad age %r (eg: 12h, 30d or 2w)' % value)
+    return timedelta(**{AGE_UNITS[match.group(2)]: int(match.group(1))})
+
+
+def metadata_changed(old, new):
+    """ Return whether the metadata of the movie changed, ignoring the
+        refresh fields.
+    """
+    strip = lambda movie: dict((k, v) for k, v in movie.iteritems() if k not in REFRESH_FIELDS)
+    return strip(old) != strip(new)
 
 
 class Refresh(Command):
 
     """ Refresh metadata of movies.
+
+    Movies are only saved when their metadata changed, else only the date of
+    their last refresh is updated.
     """
 
     help = 'refresh metadata of movies'
@@ -16,19 +51,50 @@ class Refresh(Command):
         self.add_arg('input', metavar='movie-hash-or-file', nargs='?',
                      help='Hash or path of the movie to refresh. '
                           'If not specified, refresh all movies.')
+        self.add_arg('--jobs', '-j', type=int, default=1,
+                     help='Number of movies to refresh concurrently')
+        self.add_arg('--older-than', type=parse_age, default=None,
+                     help='Only refresh movies not refreshed for this age '
+                          '(eg: 12h, 30d or 2w)')
+        self.add_arg('--changes', action='store_true', default=False,
+                     help='Use the changes feeds of datasources to skip movies '
+                          'unchanged since their last refresh')
 
     def run(self, args, config):
+        if args.jobs < 1:
+            raise KolektoRuntimeError('--jobs must be at least 1')
         mdb = self.get_metadata_db(args.tree)
-        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class)
+        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class,
+                              readonly=self.readonly)
 
         if args.input is None: # Refresh all movies
-            if printer.ask('Would you like to refresh all movies?', default=True):
-                with printer.progress(mdb.count(), task=True) as update:
-                    for movie_hash, movie in list(mdb.itermovies()):
-                        movie = mds.refresh(movie)
-                        mdb.save(movie_hash, movie)
-                        printer.verbose('Saved {hash}', hash=movie_hash)
+            movies = list(mdb.itermovies())
+            if args.older_than is not None:
+                limit = datetime.now() - args.older_than
+                movies = [(h, m) for h, m in movies if (get_refresh_date(m) or datetime.min) < limit]
+            if args.changes:
+                movies = self._skip_unchanged(mdb, mds, movies)
+            if not movies:
+                printer.p('No movie to refresh.')
+                return
+            movies = self.profile.plan_refresh(movies)
+            if args.older_than is None and not args.changes:
+                question = 'Would you like to refresh all movies?'
+            else:
+                question = 'Would you like to refresh %d movies?' % len(movies)
+            if printer.ask(question, default=True):
+                changed = 0
+                with printer.progress(len(movies), task=True) as update, mdb.transaction():
+                    for movie_hash, old, movie in self._refresh_all(mds, movies, args.jobs):
+                        if metadata_changed(old, movie):
+                            mdb.save(movie_hash, movie)
+                            printer.verbose('Saved {hash}', hash=movie_hash)
+                            changed += 1
+                        else:
+                            mdb.touch(movie_hash, movie)
                         update(1)
+                printer.p('Refreshed {count} movies, {changed} changed.',
+                          count=len(movies), changed=changed)
         else:
             movie_hash = get_hash(args.input)
 
@@ -38,9 +104,49 @@ class Refresh(Command):
                 printer.p('Unknown movie hash.')
                 return
             else:
+                old = copy.deepcopy(movie)
                 movie = mds.refresh(movie)
                 show(movie)
-                if printer.ask('Would you like to save the movie?', default=True):
+                if not metadata_changed(old, movie):
+                    mdb.touch(movie_hash, movie)
+                    printer.p('Metadata unchanged.')
+                elif printer.ask('Would you like to save the movie?', default=True):
                     mdb.save(movie_hash, movie)
                     printer.p('Saved.')
 
+    def _skip_unchanged(self, mdb, mds, movies):
+        """ Return the movies which may have changed since their last refresh
+            according to the changes feeds of datasources, the date of last
+            refresh of the others is updated.
+        """
+        now = datetime.now().strftime(IMPORT_DATE_FORMAT)
+        to_refresh = []
+        with mdb.transaction():
+            for movie_hash, movie in movies:
+                refresh_date = get_refresh_date(movie)
+                if refresh_date is None or mds.is_changed(movie, refresh_date) is not False:
+                    to_refresh.append((movie_hash, movie))
+                else:
+                    movie[REFRESH_DATE_FIELD] = now
+                    mdb.touch(movie_hash, movie)
+        printer.verbose('{count} movies unchanged since their last refresh',
+                        count=len(movies) - len(to_refresh))
+        return to_refresh
+
+    def _refresh_all(self, mds, movies, jobs):
+        """ Refresh the movies using a pool of threads, and yield the
+            (hash, old movie, refreshed movie) as they come, to be saved by
+            the caller.
+        """
+        refresh = lambda (movie_hash, movie): (movie_hash, copy.deepcopy(movie), mds.refresh(movie))
+        if jobs == 1:
+            for movie in movies:
+                yield refresh(movie)
+            return
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.imap_unordered(refresh, movies)
+            for _ in xrange(len(movies)):
+                yield results.next(WAIT_FOREVER)
+        finally:
+            pool.terminate()
@@ -0,0 +1,129 @@
+import os
+
+from kolekto.printer import printer
+from kolekto.commands import Command
+from kolekto.commands.link import walk_links
+from kolekto.exceptions import KolektoRuntimeError
+from kolekto.fastcopy import hash_file, HASH_ALGORITHMS, DEFAULT_BUFFER_SIZE
+from kolekto.helpers import JsonDbm
+from kolekto.db import (HashCache, SampleIndex, get_tree_hash_algorithm,
+                        set_tree_hash_algorithm)
+
+
+class Rehash(Command):
+
+    """ Rehash the files of the tree using the configured hash algorithm.
+
+    Each movie file is renamed to its new hash, and the metadata database,
+    the attachments and the media infos cache are updated accordingly, then
+    the links of views pointing to renamed files are updated. The new
+    algorithm is recorded once all files are rehashed, so an interrupted
+    rehash can be completed by running it again (then run kolekto link to
+    update the views). The files of movies renamed in the database but not
+    yet on the disk by an interrupted rehash are found using the hash cache
+    and renamed by the next run.
+    """
+
+    help = 'rehash the tree files using the configured hash algorithm'
+
+    def run(self, args, config):
+        algorithm = self.get_config_value('hash_algorithm')
+        current = get_tree_hash_algorithm(args.tree)
+        if algorithm == current:
+            printer.p('The tree is already hashed using {algorithm}', algorithm=algorithm)
+            return
+
+        mdb = self.get_metadata_db(args.tree)
+        directory = os.path.join(args.tree, '.kolekto')
+        hash_cache = HashCache(os.path.join(directory, HashCache.filename))
+        buffer_size = self.get_config_value('copy_buffer_size', DEFAULT_BUFFER_SIZE)
+        mediainfos_filename = os.path.join(directory, 'media-info-cache.db')
+        if os.path.exists(mediainfos_filename):
+            mediainfos_cache = JsonDbm(mediainfos_filename)
+        else:
+            mediainfos_cache = None
+
+        printer.p('Rehashing the tree from {current} to {algorithm}...',
+                  current=current, algorithm=algorithm)
+        renamed = {}
+        movies_hash = list(mdb.itermovieshash())
+        self._repair(directory, mediainfos_cache, movies_hash, hash_cache, algorithm)
+        with printer.progress(len(movies_hash), task=True) as update:
+            for old_hash in movies_hash:
+                filename = os.path.join(directory, 'movies', old_hash)
+                if not os.path.exists(filename):
+                    printer.p('Warning: file of movie {hash} not found', hash=old_hash)
+                    update(1)
+                    continue
+                compute = lambda: hash_file(filename, buffer_size,
+                                            hash_factory=HASH_ALGORITHMS[algorithm])
+                new_hash = hash_cache.hash(filename, compute, algorithm)
+                if new_hash != old_hash:
+                    self._rename(directory, mdb, mediainfos_cache, old_hash, new_hash)
+                    renamed[old_hash] = new_hash
+                update(1)
+
+        # Update the links of views:
+        relinked = 0
+        for view in config.subsections('view'):
+            links = walk_links(os.path.join(args.tree, view.args), prefix=view.args,
+                               linkbase=os.path.join(directory, 'movies'))
+            for link_filename, target in links.iteritems():
+                if target in renamed:
+                    fullname = os.path.join(args.tree, link_filename)
+                    movie_link = os.path.join(directory, 'movies', renamed[target])
+                    os.remove(fullname)
+                    os.symlink(os.path.relpath(movie_link, os.path.dirname(fullname)), fullname)
+                    relinked += 1
+
+        SampleIndex(os.path.join(directory, SampleIndex.filename)).update_from(os.path.join(directory, 'movies'))
+        set_tree_hash_algorithm(args.tree, algorithm)
+        printer.p('Rehashed {nb} files and updated {links} links.', nb=len(renamed), links=relinked)
+
+    def _repair(self, directory, mediainfos_cache, movies_hash, hash_cache, algorithm):
+        """ Rename the files left under their old hash by an interrupted
+            rehash, the new hash of each of them being in the hash cache.
+        """
+        movies_directory = os.path.join(directory, 'movies')
+        missing = set(x for x in movies_hash if not os.path.exists(os.path.join(movies_directory, x)))
+        if not missing:
+            return
+        known = set(movies_hash)
+        for name in os.listdir(movies_directory):
+            if name in known or name.startswith('partial-'):
+                continue
+            new_hash = hash_cache.lookup(os.path.join(movies_directory, name), algorithm)
+            if new_hash in missing:
+                self._rename_files(directory, mediainfos_cache, name, new_hash)
+                missing.discard(new_hash)
+                printer.p('Completed the interrupted renaming of {old} to {new}', old=name, new=new_hash)
+
+    def _rename_files(self, directory, mediainfos_cache, old_hash, new_hash):
+        # The movie file is renamed last, as it's used to find the renaming
+        # to complete after an interruption:
+        if mediainfos_cache is not None and old_hash in mediainfos_cache:
+            mediainfos_cache.save(new_hash, mediainfos_cache.get(old_hash))
+            mediainfos_cache.remove(old_hash)
+        old_attachments = os.path.join(directory, 'attachments', old_hash)
+        if os.path.isdir(old_attachments):
+            os.rename(old_attachments, os.path.join(directory, 'attachments', new_hash))
+        os.rename(os.path.join(directory, 'movies', old_hash),
+                  os.path.join(directory, 'movies', new_hash))
+
+    def _rename(self, directory, mdb, mediainfos_cache, old_hash, new_hash):
+        """ Rename everything related to the movie to its new hash.
+
+        The movie is moved to its new hash in the database by a single
+        transaction before its files are renamed, so an interruption leaves
+        either the old state or a movie whose files (and media infos cache
+        entry) are still under the old hash, renamed by the next run (see
+        :meth:`_repair`).
+        """
+        new_filename = os.path.join(directory, 'movies', new_hash)
+        if os.path.lexists(new_filename):
+            raise KolektoRuntimeError('Unable to rename %s, %s already exists' % (old_hash, new_hash))
+        with mdb.transaction():
+            mdb.save(new_hash, mdb.get(old_hash))
+            mdb.remove(old_hash)
+        self._rename_files(directory, mediainfos_cache, old_hash, new_hash)
+        printer.verbose('Renamed {old} to {new}', old=old_hash, new=new_hash)
@@ -0,0 +1,29 @@
+import os
+
+from kolekto.printer import printer
+from kolekto.commands import Command
+from kolekto.db import ChangeLog
+
+
+class Reindex(Command):
+
+    """ Rebuild the facet indexes of the metadata database.
+
+    A missing change log is also created (with a new sequence number for
+    each movie), an existing one is kept as is since incremental dumps
+    depend on its sequence numbers.
+    """
+
+    help = 'rebuild the facet indexes (and create a missing change log)'
+
+    def run(self, args, config):
+        changes_filename = os.path.join(args.tree, '.kolekto', ChangeLog.filename)
+        changes_missing = not os.path.exists(changes_filename)
+        mdb = self.get_metadata_db(args.tree)
+        mdb.facets.rebuild(mdb.itermovies())
+        for facet in mdb.facets.FACETS:
+            printer.verbose('Indexed {nb} values of {facet}', facet=facet,
+                            nb=len(mdb.facets.counts(facet)))
+        if changes_missing:
+            printer.p('Created the change log.')
+        printer.p('Reindexed {nb} movies.', nb=mdb.count())
@@ -1,24 +1,228 @@
+import re
+import gzip
 import json
+from itertools import islice
+from collections import deque
+from multiprocessing import Pool
 
 from kolekto.printer import printer
 from kolekto.commands import Command
+from kolekto.exceptions import KolektoRuntimeError
+from kolekto.helpers import WAIT_FOREVER
+
+
+HASH_RE = re.compile('^[0-9a-f]+$')
+
+# Number of lines of jsonl dumps parsed by each task of the worker processes:
+PARSE_BATCH_SIZE = 256
+
+# Maximum number of parsed batches waiting to be written, per process:
+PARSE_BATCHES_AHEAD = 2
+
+
+def validate_record(record):
+    """ Check a dump record, return the record or raise a ValueError.
+    """
+    if not isinstance(record, dict):
+        raise ValueError('record is not an object')
+    if not isinstance(record.get('hash'), basestring) or not HASH_RE.match(record['hash']):
+        raise ValueError('bad hash %r' % record.get('hash'))
+    if not record.get('deleted') and not isinstance(record.get('movie'), dict):
+        raise ValueError('bad movie for hash %s' % record['hash'])
+    record['hash'] = str(record['hash'])
+    return record
+
+
+def parse_line(line):
+    """ Parse and validate a line of a jsonl dump, return a (record, error)
+        couple. Used by the worker processes.
+    """
+    try:
+        return validate_record(json.loads(line)), None
+    except ValueError as err:
+        return None, str(err)
+
+
+def parse_lines(lines):
+    return [parse_line(x) for x in lines]
+
+
+def iter_lines(fdump):
+    for line in fdump:
+        if line.strip():
+            yield line
+
+
+SEPARATORS_RE = re.compile(r'[\s,]*')
+
+
+def iter_json_list(fdump, chunk_size=64 * 1024):
+    """ Iterate over the items of a json list read incrementally from a
+        file, yield (record, error) couples.
+    """
+    decoder = json.JSONDecoder()
+    buf = fdump.read(chunk_size).lstrip()
+    if not buf.startswith('['):
+        raise KolektoRuntimeError('The dump is not a json list')
+    pos = 1
+    eof = False
+    while True:
+        pos = SEPARATORS_RE.match(buf, pos).end()
+        if buf.startswith(']', pos):
+            return
+        try:
+            item, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise KolektoRuntimeError('Truncated or invalid json dump')
+            # The item is not complete, read more data:
+            chunk = fdump.read(chunk_size)
+            eof = not chunk
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        try:
+            yield validate_record(item), None
+        except ValueError as err:
+            yield None, str(err)
+
+
+def open_dump(filename):
+    """ Open a dump file, decompressing it if needed.
+    """
+    fdump = open(filename, 'rb')
+    if fdump.read(2) == '\x1f\x8b':
+        fdump.close()
+        return gzip.open(filename, 'rb')
+    fdump.seek(0)
+    return fdump
+
+
+class _Prepend(object):
+
+    """ A file wrapper giving back data already read from the file.
+    """
+
+    def __init__(self, data, fileobj):
+        self._data = data
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        data, self._data = self._data, ''
+        if size < 0:
+            return data + self._fileobj.read()
+        return data + self._fileobj.read(size - len(data))
+
+    def __iter__(self):
+        data, self._data = self._data, ''
+        for line in self._fileobj:
+            yield data + line
+            data = ''
+        if data:
+            yield data
 
 
 class Restore(Command):
 
     """ Restore metadata from a json dump.
+
+    Both json list and jsonl dumps (optionally gzipped) are accepted and
+    parsed incrementally. Records are written in a single transaction synced
+    every db_sync_interval records. Removal records of incremental dumps
+    are applied too, so incremental dumps can be restored in order.
     """
 
     help = 'Restore metadata from a json dump'
 
     def prepare(self):
         self.add_arg('file', help='The json dump file to restore')
+        mode = self._aparser.add_mutually_exclusive_group()
+        mode.add_argument('--merge', action='store_true', default=False,
+                          help='Merge fields of the dump into existing movies')
+        mode.add_argument('--skip-existing', action='store_true', default=False,
+                          help='Keep existing movies untouched (to resume an '
+                               'interrupted restore)')
+        self.add_arg('--jobs', '-j', type=int, default=1,
+                     help='Number of processes used to parse jsonl dumps')
+
+    def _records(self, fdump, jobs):
+        """ Iterate over (record, error) couples of the dump.
+        """
+        first = fdump.read(1)
+        while first.isspace():
+            first = fdump.read(1)
+        fdump = _Prepend(first, fdump)
+        if first == '[':
+            # The dump is a json list, parsed in the main process:
+            records = iter_json_list(fdump)
+        elif jobs > 1:
+            for result in self._parse_concurrently(fdump, jobs):
+                yield result
+            return
+        else:
+            records = (parse_line(x) for x in iter_lines(fdump))
+        for result in records:
+            yield result
+
+    def _parse_concurrently(self, fdump, jobs):
+        """ Parse the lines of a jsonl dump by batches in a pool of processes,
+            and yield (record, error) couples in the order of the dump.
+
+        Only a few batches are submitted ahead of the consumer, so the dump
+        isn't read (and kept in memory) faster than records are written.
+        """
+        lines = iter_lines(fdump)
+        pending = deque()
+        pool = Pool(jobs)
+        try:
+            while True:
+                batch = list(islice(lines, PARSE_BATCH_SIZE))
+                if batch:
+                    pending.append(pool.apply_async(parse_lines, (batch,)))
+                if not pending:
+                    break
+                if not batch or len(pending) >= jobs * PARSE_BATCHES_AHEAD:
+                    for result in pending.popleft().get(WAIT_FOREVER):
+                        yield result
+        finally:
+            pool.terminate()
 
     def run(self, args, config):
+        if args.jobs < 1:
+            raise KolektoRuntimeError('--jobs must be at least 1')
         mdb = self.get_metadata_db(args.tree)
-        with open(args.file) as fdump:
-            dump = json.load(fdump)
-        for movie in dump:
-            mdb.save(movie['hash'], movie['movie'])
-            printer.verbose('Loaded {hash}', hash=movie['hash'])
-        printer.p('Loaded {nb} movies.', nb=len(dump))
+        loaded = skipped = invalid = removed = 0
+        with open_dump(args.file) as fdump, mdb.transaction():
+            for record, error in self._records(fdump, args.jobs):
+                if error is not None:
+                    printer.p('Invalid record: {err}', err=error)
+                    invalid += 1
+                    continue
+                movie_hash, movie = record['hash'], record.get('movie')
+                if record.get('deleted'):
+                    if movie_hash in mdb:
+                        mdb.remove(movie_hash)
+                        printer.verbose('Removed {hash}', hash=movie_hash)
+                        removed += 1
+                    continue
+                if args.skip_existing or args.merge:
+                    try:
+                        existing = mdb.get(movie_hash)
+                    except KeyError:
+                        pass
+                    else:
+                        if args.skip_existing:
+                            skipped += 1
+                            continue
+                        existing.update(movie)
+                        movie = existing
+                mdb.save(movie_hash, movie)
+                printer.verbose('Loaded {hash}', hash=movie_hash)
+                loaded += 1
+        printer.p('Loaded {nb} movies.', nb=loaded)
+        if removed:
+            printer.p('Removed {nb} movies.', nb=removed)
+        if skipped:
+            printer.p('Skipped {nb} existing movies.', nb=skipped)
+        if invalid:
+            printer.p('Ignored {nb} invalid records.', nb=invalid)
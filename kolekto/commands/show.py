@@ -52,13 +52,15 @@ class Show(Command):
     """
 
     help = 'show informations about a movie'
+    readonly = True
 
     def prepare(self):
         self.add_arg('input', metavar='movie-hash-or-file')
 
     def run(self, args, config):
         mdb = self.get_metadata_db(args.tree)
-        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class)
+        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class,
+                              readonly=self.readonly)
 
         movie_hash = get_hash(args.input)
 
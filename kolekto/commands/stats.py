@@ -44,14 +44,14 @@ class Stats(Command):
     """
 
     help = 'get stats about the movie collection'
+    readonly = True
 
     def run(self, args, config):
         mdb = self.get_metadata_db(args.tree)
-        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class)
+        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class,
+                              readonly=self.readonly)
         total_runtime = 0
         total_size = 0
-        count_by_genre = defaultdict(lambda: 0)
-        count_by_director = defaultdict(lambda: 0)
         count_by_quality = defaultdict(lambda: 0)
         count_by_container = defaultdict(lambda: 0)
         for movie_hash, movie in mdb.itermovies():
@@ -59,17 +59,13 @@ class Stats(Command):
             movie = mds.attach(movie_hash, movie)
             total_runtime += movie.get('runtime', 0)
             total_size += os.path.getsize(movie_fullpath)
-            for genre in movie.get('genres', []):
-                count_by_genre[genre] += 1
-            for director in movie.get('directors', []):
-                count_by_director[director] += 1
             count_by_quality[movie.get('quality', 'n/a')] += 1
             count_by_container[movie.get('container', 'n/a')] += 1
 
         printer.p('<b>Number of movies:</b>', mdb.count())
         printer.p('<b>Total runtime:</b>', timedelta(seconds=total_runtime * 60))
         printer.p('<b>Total size:</b>', humanize_filesize(total_size))
-        printer.p('<b>Genres top3:</b>', format_top(count_by_genre))
-        printer.p('<b>Director top3:</b>', format_top(count_by_director))
+        printer.p('<b>Genres top3:</b>', format_top(mdb.facets.counts('genres')))
+        printer.p('<b>Director top3:</b>', format_top(mdb.facets.counts('directors')))
         printer.p('<b>Quality:</b>', format_top(count_by_quality, None))
         printer.p('<b>Container:</b>', format_top(count_by_container, None))
\ No newline at end of file
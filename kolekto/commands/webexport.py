@@ -100,6 +100,7 @@ class WebExport(Command):
     """
 
     help = 'export movies listing in a web page'
+    readonly = True
 
     def prepare(self):
         self.add_arg('webexport', metavar='webexport', default='default', nargs='?')
@@ -123,7 +124,8 @@ class WebExport(Command):
 
     def run(self, args, config):
         mdb = self.get_metadata_db(args.tree)
-        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class)
+        mds = MovieDatasource(config.subsections('datasource'), args.tree, self.profile.object_class,
+                              readonly=self.readonly)
         webexport = self._config(args, config)
         columns = [(x.args, x) for x in webexport['columns']]
         movies = []
@@ -6,9 +6,11 @@ import pkg_resources
 from confiture import Confiture
 from confiture.schema import ValidationError
 from confiture.schema.containers import Section, Value, List, Choice
-from confiture.schema.types import String, Boolean
+from confiture.schema.types import String, Boolean, Integer
 
 from .profiles.movies import Movies
+from .db import MoviesMetadata, get_db_backends
+from .fastcopy import HASH_ALGORITHMS
 
 
 class Profile(String):
@@ -30,6 +32,24 @@ class Profile(String):
         raise NotImplementedError()
 
 
+class DbBackend(String):
+
+    """ Type for metadata database backends.
+
+    This type load know backends using distutils entry-points.
+    """
+
+    def validate(self, value):
+        value = super(DbBackend, self).validate(value)
+        backend = get_db_backends().get(value)
+        if backend is None:
+            raise ValidationError('Unknown database backend')
+        return value, backend
+
+    def cast(self, value):
+        raise NotImplementedError()
+
+
 class ViewKolektoConfig(Section):
 
     _meta = {'args': Value(String()),
@@ -89,6 +109,17 @@ class WebExportKolektoConfig(Section):
 class RootKolektoConfig(Section):
 
     profile = Value(Profile(), default=('movies', Movies))
+    db_backend = Value(DbBackend(), default=('gdbm', MoviesMetadata))
+    db_sync_interval = Value(Integer(min=0), default=1000)
+    db_codec = Choice({'json': 'json', 'marshal': 'marshal', 'compact': 'compact'},
+                      default='json')
+    db_cache_size = Value(Integer(min=0), default=0)
+    db_lock_timeout = Value(Integer(min=0), default=30)
+    db_autocompact = Value(Integer(min=0, max=100), default=50)
+    copy_buffer_size = Value(Integer(min=64 * 1024), default=4 * 1024 * 1024)
+    hash_algorithm = Choice(dict((x, x) for x in HASH_ALGORITHMS), default='sha1')
+    http_cache_size = Value(Integer(min=0), default=64)  # in MiB
+    http_pool_size = Value(Integer(min=1), default=10)  # connections per host
     view = ViewKolektoConfig()
     datasource = DatasourceKolektoConfig()
     listing = ListingKolektoConfig()
@@ -2,11 +2,29 @@
 """
 
 import pkg_resources
+from datetime import datetime
 
 from confiture.schema.containers import Section, Value
 from confiture.schema.types import String
 
 from ..exceptions import KolektoRuntimeError
+from ..db import IMPORT_DATE_FORMAT
+
+
+# Fields of movies storing the date of their last refresh and the names of
+# the datasources which refreshed them:
+REFRESH_DATE_FIELD = '_refresh_date'
+REFRESH_DATASOURCES_FIELD = '_refresh_datasources'
+
+
+def get_refresh_date(movie):
+    """ Return the datetime of the last refresh of the movie, or None if it
+        has never been refreshed.
+    """
+    try:
+        return datetime.strptime(movie.get(REFRESH_DATE_FIELD), IMPORT_DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None  # No or bad refresh date
 
 
 class DefaultDatasourceSchema(Section):
@@ -20,15 +38,19 @@ class DefaultDatasourceSchema(Section):
 class Datasource(object):
 
     """ Base class for all movies database datasources.
+
+    Datasources of a read-only command (`readonly` is True) must not write
+    in the tree.
     """
 
     config_schema = DefaultDatasourceSchema()
 
-    def __init__(self, name, tree, config, object_class=dict):
+    def __init__(self, name, tree, config, object_class=dict, readonly=False):
         self.name = name
         self.tree = tree
         self.config = config
         self.object_class = object_class
+        self.readonly = readonly
 
     def search(self, title, **kwargs):
         """ Search for a movie title in database.
@@ -41,6 +63,12 @@ class Datasource(object):
         """ Refresh the movie's metadata.
         """
 
+    def is_changed(self, movie, since):
+        """ Return whether the movie changed in the database since the
+            provided datetime, or None if unknown.
+        """
+        return None
+
     def attach(self, movie_hash, movie):
         return movie
 
@@ -50,7 +78,7 @@ class MovieDatasource(object):
     """ Movie database.
     """
 
-    def __init__(self, datasources_config, tree, object_class=dict):
+    def __init__(self, datasources_config, tree, object_class=dict, readonly=False):
         self._object_class = object_class
         self._datasources = []
         for datasource_config in datasources_config:
@@ -59,7 +87,8 @@ class MovieDatasource(object):
                 raise KolektoRuntimeError('Bad datasource %r' % datasource_config.args)
             datasource_class = entrypoints[0].load()
             datasource_config = datasource_class.config_schema.validate(datasource_config)
-            ds = datasource_class(entrypoints[0].name, tree, datasource_config, self._object_class)
+            ds = datasource_class(entrypoints[0].name, tree, datasource_config, self._object_class,
+                                  readonly=readonly)
             self._datasources.append(ds)
 
     def search(self, title, **kwargs):
@@ -68,12 +97,30 @@ class MovieDatasource(object):
                 yield datasource, movie
 
     def refresh(self, movie):
+        refreshed_by = []
         for datasource in self._datasources:
             refreshed = datasource.refresh(movie)
             if refreshed:
                 movie.update(refreshed)
+                refreshed_by.append(datasource.name)
+        movie[REFRESH_DATE_FIELD] = datetime.now().strftime(IMPORT_DATE_FORMAT)
+        movie[REFRESH_DATASOURCES_FIELD] = refreshed_by
         return movie
 
+    def is_changed(self, movie, since):
+        """ Return whether the movie changed in any datasource since the
+            provided datetime: False only if every datasource knows it is
+            unchanged, else True, or None if a datasource doesn't know.
+        """
+        changed = False if self._datasources else None
+        for datasource in self._datasources:
+            result = datasource.is_changed(movie, since)
+            if result:
+                return True
+            elif result is None:
+                changed = None
+        return changed
+
     def attach(self, movie_hash, movie):
         for datasource in self._datasources:
             movie = datasource.attach(movie_hash, movie)
@@ -0,0 +1,265 @@
+""" A persistent cache of the HTTP responses of datasources.
+"""
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+
+from kolekto.printer import printer
+from kolekto.helpers import JsonDbm
+
+
+ONE_DAY = 24 * 3600
+
+# Minimum delay between two updates of the last use date of a record:
+TOUCH_INTERVAL = 3600
+
+# Fraction of the maximum size kept when the cache is full:
+EVICTION_RATIO = 0.9
+
+# Number of writes between two syncs of the cache:
+SYNC_INTERVAL = 100
+
+# Parameters removed from the URLs to make the cache keys:
+SECRET_PARAMETERS_RE = re.compile(r'([?&])api_key=[^&]*&?')
+
+
+class CachedResponse(object):
+
+    """ A response served from the cache, providing the attributes of
+        requests responses used by datasources.
+    """
+
+    status_code = 200
+    reason = 'OK'
+    ok = True
+
+    def __init__(self, text):
+        self.text = text
+
+
+class HttpCache(JsonDbm):
+
+    """ A cache of the successful responses of GET requests, stored under
+        their URL (without secret parameters).
+
+    Each record stores the body of the response, its ETag and Last-Modified
+    headers used to revalidate it once expired, its expiration date and the
+    date of its last use. When the total size of the bodies exceeds the
+    maximum size, the least recently used records are evicted. Writes are
+    synced every :data:`SYNC_INTERVAL` writes and when the cache is closed
+    (see :meth:`close_all`).
+
+    Concurrent requests of the same URL (in threads) only do a single
+    request, and the responses fetched during the run are kept in memory (up
+    to the maximum size, least recently used first evicted), even if the
+    persistent cache is disabled.
+
+    In `readonly` mode, the cache is used but never updated.
+
+    :cvar options: global options of caches, see :meth:`configure` (a
+                   max_size of 0 disables the persistent cache)
+    """
+
+    filename = 'http-cache.db'
+
+    options = {'enabled': True, 'max_size': 64 * 1024 * 1024}
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, **options):
+        """ Set the global options of caches (enabled and max_size).
+        """
+        cls.options.update(options)
+
+    @classmethod
+    def for_tree(cls, tree, readonly=False):
+        """ Return the cache of the tree, shared by all datasources.
+        """
+        filename = os.path.join(tree, '.kolekto', cls.filename)
+        with cls._instances_lock:
+            if filename not in cls._instances:
+                if readonly and not os.path.exists(filename):
+                    cls._instances[filename] = cls(None, readonly=True)
+                else:
+                    cls._instances[filename] = cls(filename, readonly=readonly)
+            return cls._instances[filename]
+
+    @classmethod
+    def close_all(cls):
+        """ Sync and close the caches opened by :meth:`for_tree`.
+        """
+        with cls._instances_lock:
+            for cache in cls._instances.itervalues():
+                cache.close()
+            cls._instances.clear()
+
+    def __init__(self, filename, readonly=False):
+        self._persistent = (filename is not None and self.options['enabled']
+                            and self.options['max_size'] > 0)
+        if self._persistent:
+            super(HttpCache, self).__init__(filename, object_class=lambda x: x, readonly=readonly)
+            self._size = self.get('#size') if '#size' in self else 0
+        self._readonly = readonly
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._fetched = OrderedDict()  # Responses fetched during this run
+        self._fetched_size = 0
+        self._inflight = {}
+
+    def close(self):
+        if self._persistent:
+            with self._lock:
+                self.sync()
+                super(HttpCache, self).close()
+            self._persistent = False
+
+    def _written(self):
+        # Sync only every SYNC_INTERVAL writes, a lost write only costs a
+        # request:
+        self._unsynced += 1
+        if self._unsynced >= SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        if self._dirty:
+            self._db['#size'] = self._encode(self._size)
+            self._dirty = False
+        super(HttpCache, self).sync()
+
+    @staticmethod
+    def key(url):
+        if isinstance(url, unicode):
+            url = url.encode('utf8')
+        return SECRET_PARAMETERS_RE.sub(r'\1', url).rstrip('?&')
+
+    def get_response(self, url, ttl, fetch):
+        """ Get the response of the URL from the cache, or using the `fetch`
+            callable.
+
+        :param ttl: number of seconds a fetched response is fresh
+        :param fetch: a callable taking a dict of headers to add to the
+                      request and returning a requests response
+        :return: a response, :class:`CachedResponse` or requests response
+        """
+        key = self.key(url)
+        with self._lock:
+            if key in self._fetched:
+                return CachedResponse(self._remember(key))
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                inflight = self._inflight[key] = threading.Event()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            # Wait for the thread doing the same request:
+            inflight.wait()
+            with self._lock:
+                if key in self._fetched:
+                    return CachedResponse(self._remember(key))
+            return self.get_response(url, ttl, fetch)  # The request failed, retry it
+        try:
+            response = self._get_response(key, url, ttl, fetch)
+            if response.ok:
+                with self._lock:
+                    self._remember(key, response.text)
+            return response
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            inflight.set()
+
+    def _remember(self, key, text=None):
+        """ Keep the response text of the key in memory (or mark it as
+            recently used if no text is given) and return it, evicting the
+            least recently used responses above the maximum size. Must be
+            called with the lock held.
+        """
+        if key in self._fetched:
+            previous = self._fetched.pop(key)
+            self._fetched_size -= len(previous)
+            if text is None:
+                text = previous
+        max_size = self.options['max_size']
+        if len(text) <= max_size:
+            while self._fetched and self._fetched_size + len(text) > max_size:
+                self._fetched_size -= len(self._fetched.popitem(last=False)[1])
+            self._fetched[key] = text
+            self._fetched_size += len(text)
+        return text
+
+    def _get_response(self, key, url, ttl, fetch):
+        if not self._persistent:
+            return fetch({})
+        with self._lock:
+            record = self.get(key) if key in self else None
+        now = time.time()
+        if record is not None and record['expires'] > now:
+            printer.debug('Cache hit for {url}', url=key)
+            self._touch(key, record, now)
+            return CachedResponse(record['body'])
+
+        headers = {}
+        if record is not None:
+            if record.get('etag'):
+                headers['If-None-Match'] = record['etag']
+            if record.get('last_modified'):
+                headers['If-Modified-Since'] = record['last_modified']
+        response = fetch(headers)
+        if record is not None and response.status_code == 304:
+            printer.debug('Cache revalidated for {url}', url=key)
+            record['expires'] = now + ttl
+            self._touch(key, record, now, force=True)
+            return CachedResponse(record['body'])
+        elif response.ok:
+            self._store(key, {'body': response.text,
+                              'etag': response.headers.get('ETag'),
+                              'last_modified': response.headers.get('Last-Modified'),
+                              'expires': now + ttl,
+                              'accessed': now})
+        return response
+
+    def _touch(self, key, record, now, force=False):
+        """ Update the last use date of the record (only once in a while,
+            unless forced).
+        """
+        if not self._readonly and (force or now - record['accessed'] >= TOUCH_INTERVAL):
+            record['accessed'] = now
+            with self._lock:
+                self.save(key, record)
+
+    def _store(self, key, record):
+        if self._readonly:
+            return
+        with self._lock:
+            if key in self:
+                self._size -= len(self.get(key)['body'])
+            self._size += len(record['body'])
+            self._dirty = True
+            self.save(key, record)
+            if self._size > self.options['max_size']:
+                self._evict()
+
+    def _evict(self):
+        """ Remove the least recently used records until the cache size is
+            under the eviction ratio of its maximum size.
+        """
+        records = []
+        for key in self.iterkeys():
+            if key != '#size':
+                record = self.get(key)
+                records.append((record['accessed'], len(record['body']), key))
+        records.sort()
+        target = self.options['max_size'] * EVICTION_RATIO
+        with self.transaction():
+            for _, size, key in records:
+                if self._size <= target:
+                    break
+                self.remove(key)
+                self._size -= size
+        printer.debug('Evicted responses from the HTTP cache, {size} bytes left', size=self._size)
@@ -0,0 +1,244 @@
+""" HTTP client shared by the datasources, handling rate limiting, retries
+    and unavailability of the remote APIs.
+"""
+
+import time
+import random
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from kolekto.printer import printer
+from kolekto.exceptions import KolektoRuntimeError
+from kolekto.helpers import TokenBucket
+
+
+DEFAULT_TIMEOUT = 30  # in seconds
+DEFAULT_RETRIES = 5
+DEFAULT_POOL_SIZE = 10
+
+# Delays of the exponential backoff between retries, in seconds:
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+# The circuit is opened after this number of consecutive failures, and
+# requests fail immediately until the cooldown delay (in seconds) is elapsed:
+BREAKER_THRESHOLD = 10
+BREAKER_COOLDOWN = 60
+
+# Status codes of responses which are retried:
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def response_error(response):
+    """ Return a message describing the error of the response.
+    """
+    err_msg = 'server reported error: %s' % response.status_code
+    # Show the error reason message to the user if the requests
+    # version is sufficiently recent:
+    if getattr(response, 'reason', None):
+        err_msg += ' (%s)' % response.reason
+    return err_msg
+
+
+def parse_retry_after(value):
+    """ Return the delay in seconds of a Retry-After header (a number of
+        seconds or a HTTP date), or None if it can't be parsed.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is not None:
+        return max(0, mktime_tz(date) - time.time())
+
+
+class CircuitOpenError(KolektoRuntimeError):
+
+    """ Raised when a request is not sent because the circuit is open.
+    """
+
+
+class CircuitBreaker(object):
+
+    """ Track consecutive failures of requests to an API, and open the
+        circuit (to fail fast) when the API looks unavailable.
+
+    Once the cooldown delay is elapsed, requests are allowed again and a
+    single failure opens the circuit again.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened = None
+        self._lock = threading.Lock()
+
+    def check(self, name):
+        """ Raise :exc:`CircuitOpenError` if the circuit is open.
+        """
+        with self._lock:
+            if self._opened is not None and time.time() < self._opened + self.cooldown:
+                raise CircuitOpenError('%s is unavailable (too many failures), '
+                                       'try again later' % name)
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened = time.time()
+
+
+class HttpClient(object):
+
+    """ A HTTP client, which can be shared by several threads.
+
+    Requests are sent at the rate allowed by the `rate_limit` (requests per
+    `rate_period` seconds, 0 to disable), and failed requests (connection
+    errors, timeouts, server errors and 429 responses) are retried with an
+    exponential backoff with jitter, or after the delay requested by the
+    Retry-After header of the response (in which case all threads wait).
+
+    Unless a session is given, clients send their requests through a single
+    shared session keeping alive a pool of connections per host (at most
+    `pool_size` connections, which should not be less than the number of
+    threads sending requests) and accepting compressed responses.
+
+    :param name: name of the API, used in messages
+    :cvar options: global options of clients, see :meth:`configure`
+    """
+
+    options = {'pool_size': DEFAULT_POOL_SIZE}
+
+    _session = None
+    _session_lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, **options):
+        """ Set the global options of clients (pool_size), before the
+            first request.
+        """
+        cls.options.update(options)
+
+    @classmethod
+    def shared_session(cls):
+        """ Return the session shared by clients, created on first use.
+        """
+        with cls._session_lock:
+            if cls._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_maxsize=cls.options['pool_size'])
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers['Accept-Encoding'] = 'gzip, deflate'
+                cls._session = session
+            return cls._session
+
+    @classmethod
+    def connection_stats(cls):
+        """ Return the number of requests sent and connections opened by the
+            shared session.
+        """
+        sent = opened = 0
+        if cls._session is not None:
+            for adapter in set(cls._session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    sent += pool.num_requests
+                    opened += pool.num_connections
+        return sent, opened
+
+    def __init__(self, name, rate_limit=0, rate_period=1, timeout=DEFAULT_TIMEOUT,
+                 retries=DEFAULT_RETRIES, breaker=None, session=None):
+        self.name = name
+        if rate_limit:
+            self.rate_limiter = TokenBucket(rate_limit / float(rate_period), capacity=rate_limit)
+        else:
+            self.rate_limiter = None
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.session = self.shared_session() if session is None else session
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, headers=None):
+        """ Send a GET request and return the response.
+
+        Responses which are not retried (such as 404 responses) are returned
+        to the caller, a :exc:`KolektoRuntimeError` is raised when the
+        request still fails after all retries.
+        """
+        for attempt in xrange(self.retries + 1):
+            self.breaker.check(self.name)
+            self._wait()
+            printer.debug('Requesting {url}', url=url)
+            try:
+                response = self.session.get(url, params=params, headers=headers,
+                                            timeout=self.timeout)
+            except requests.RequestException as err:
+                response = None
+                error = str(err)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    self.breaker.success()
+                    return response
+                error = response_error(response)
+            self.breaker.failure()
+            if attempt < self.retries:
+                delay = self._delay(attempt, response)
+                printer.debug('Request failed ({error}), retrying in {delay:.1f}s...',
+                              error=error, delay=delay)
+                time.sleep(delay)
+        raise KolektoRuntimeError('Unable to get the URL, %s' % error)
+
+    def _wait(self):
+        """ Wait for the end of a pause requested by the server, and for the
+            rate limiter.
+        """
+        with self._lock:
+            pause = self._paused_until - time.time()
+        if pause > 0:
+            time.sleep(pause)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+    def _delay(self, attempt, response):
+        """ Return the delay before the retry of a failed request.
+        """
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            if retry_after is not None:
+                # Pause all the threads sending requests to the server:
+                with self._lock:
+                    self._paused_until = max(self._paused_until, time.time() + retry_after)
+                return retry_after
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+        return random.uniform(delay / 2.0, delay)
+
+
+# Clients shared by the datasources, see get_client:
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(key, name, **options):
+    """ Return the client registered under the key, created with the name and
+        options on first use, so datasources using the same API share their
+        rate limit and circuit breaker.
+    """
+    with clients_lock:
+        if key not in clients:
+            clients[key] = HttpClient(name, **options)
+        return clients[key]
@@ -1,9 +1,12 @@
 import os
+import gdbm
 import logging
 import datetime
 
+from kolekto.printer import printer
 from kolekto.datasources import Datasource
-from kolekto.helpers import JsonDbm
+from kolekto.exceptions import KolektoRuntimeError
+from kolekto.helpers import JsonDbm, FileLock
 from kolekto.commands.stats import humanize_filesize
 
 import kaa.metadata
@@ -13,19 +16,52 @@ import kaa.metadata
 metadata_logger = logging.getLogger('metadata')
 metadata_logger.setLevel(logging.CRITICAL)
 
+# Seconds to wait for the lock of the media infos cache before to give up
+# caching the parsed media infos:
+CACHE_LOCK_TIMEOUT = 5
+
 
 class MediainfosDatasource(Datasource):
 
+    """ Attach the media infos of movie files, parsed using kaa.metadata.
+
+    Parsed media infos are stored in a cache, read without lock. Each missing
+    entry is written by opening the cache for writing under its own short
+    lock (and not the tree lock), so read-only commands (which are the main
+    users of media infos) fill the cache too. Entries are not cached while
+    another command holds the cache open for writing (eg: rehash).
+    """
+
     def __init__(self, *args, **kwargs):
         super(MediainfosDatasource, self).__init__(*args, **kwargs)
-        # Open the media infos cache:
-        cache_filename = os.path.join(self.tree, '.kolekto', 'media-info-cache.db')
-        self._cache = JsonDbm(cache_filename)
+        self._cache_filename = os.path.join(self.tree, '.kolekto', 'media-info-cache.db')
+        self._cache_lock = os.path.join(self.tree, '.kolekto', 'media-info-cache.lock')
+        self._cache = None
+
+    def _cached(self, movie_hash):
+        """ Return the cached media infos of the movie, or None.
+        """
+        if self._cache is None:
+            if not os.path.exists(self._cache_filename):
+                return None
+            self._cache = JsonDbm(self._cache_filename, readonly=True)
+        if movie_hash in self._cache:
+            return self._cache.get(movie_hash)
+
+    def _store(self, movie_hash, media_infos):
+        try:
+            with FileLock(self._cache_lock, timeout=CACHE_LOCK_TIMEOUT, owner='media infos cache'):
+                cache = JsonDbm(self._cache_filename)
+                try:
+                    cache.save(movie_hash, media_infos)
+                finally:
+                    cache.close()
+        except (KolektoRuntimeError, gdbm.error) as err:
+            printer.debug('Media infos of {hash} not cached: {err}', hash=movie_hash, err=err)
 
     def attach(self, movie_hash, movie):
-        if movie_hash in self._cache:
-            media_infos = self._cache.get(movie_hash)
-        else:
+        media_infos = self._cached(movie_hash)
+        if media_infos is None:
             filename = os.path.join(self.tree, '.kolekto', 'movies', movie_hash)
             infos = kaa.metadata.parse(filename)
             if infos is None:
@@ -62,7 +98,7 @@ class MediainfosDatasource(Datasource):
             # Get the file size
             media_infos['size'] = humanize_filesize(stat.st_size)
 
-            self._cache.save(movie_hash, media_infos)
+            self._store(movie_hash, media_infos)
 
         movie.update(media_infos)
         return movie
@@ -3,60 +3,191 @@
 
 import json
 import requests
-import time
-from datetime import datetime
+import threading
+from itertools import izip
+from datetime import datetime, timedelta
 
 from kolekto.printer import printer
 from kolekto.datasources import Datasource, DefaultDatasourceSchema
+from kolekto.datasources.httpcache import HttpCache, ONE_DAY
+from kolekto.datasources.httpclient import get_client, response_error, DEFAULT_TIMEOUT, DEFAULT_RETRIES
 from kolekto.exceptions import KolektoRuntimeError
+from kolekto.helpers import concurrent_imap
+from kolekto.tmdb_parsing import (MOVIE_APPENDED, SERIES_APPENDED,
+                                  EPISODE_APPENDED, parse_year, parse_directors,
+                                  parse_movie, parse_series, parse_season,
+                                  parse_season_episode, parse_episode)
 
 from confiture.schema.containers import Value
 from confiture.schema.types import String, Integer
 
 
-requests_session = requests.Session()
+# Maximum number of concurrent requests done to complete search results:
+SEARCH_CONCURRENCY = 8
+
+# Maximum age of the changes available in the changes feeds of the API:
+CHANGES_MAX_AGE = timedelta(days=14)
+
+
+def tmdb_client(datasource):
+    """ Return the client of the TMDB API, shared by all datasources (the
+        rate limit quota is per API key and IP).
+    """
+    return get_client('tmdb', 'TMDB',
+                      rate_limit=datasource.config.get('rate_limit'), rate_period=10,
+                      timeout=datasource.config.get('timeout'),
+                      retries=datasource.config.get('retries'))
+
+
+def cached_get(datasource, url, ttl):
+    """ Get the URL on the TMDB API through the HTTP cache of the tree of the
+        datasource.
+    """
+    client = tmdb_client(datasource)
+    cache = HttpCache.for_tree(datasource.tree, datasource.readonly)
+    return cache.get_response(url, ttl, lambda headers: client.get(url, headers=headers))
+
+
+class TmdbChangesFeed(object):
+
+    """ The changes feed of the TMDB API used by a datasource.
+    """
+
+    def __init__(self, datasource):
+        self._datasource = datasource
+
+    def changed_ids(self, day):
+        """ Return the set of ids changed on the day (YYYY-MM-DD).
+        """
+        changed = set()
+        page = 1
+        while True:
+            changes = self._datasource._get(self._datasource.URL_CHANGES, start=day, end=day, page=page)
+            changed.update(x['id'] for x in changes['results'])
+            if page >= changes.get('total_pages', 1):
+                return changed
+            page += 1
+
+
+class LocalChangesFeed(object):
+
+    """ A changes feed read from a local JSON file mapping days (YYYY-MM-DD)
+        to the lists of ids changed on each day, used in place of the feed of
+        the API (eg: in tests).
+    """
+
+    def __init__(self, filename):
+        try:
+            with open(filename) as ffeed:
+                self._changes = json.load(ffeed)
+        except (IOError, ValueError) as err:
+            raise KolektoRuntimeError('Unable to read the changes feed %s: %s' % (filename, err))
+
+    def changed_ids(self, day):
+        return set(self._changes.get(day, ()))
 
 
 class TmdbDatasourceSchema(DefaultDatasourceSchema):
 
     api_key = Value(String())
     max_results = Value(Integer(min=1), default=None)
+    rate_limit = Value(Integer(min=0), default=40)  # Requests per 10 seconds, 0 to disable
+    timeout = Value(Integer(min=1), default=DEFAULT_TIMEOUT)
+    retries = Value(Integer(min=0), default=DEFAULT_RETRIES)
+    changes_feed = Value(String(), default=None)  # Local stand-in of the changes feed
+
 
+class BaseTmdbDatasource(Datasource):
 
-class TmdbDatasource(Datasource):
+    """ Base class of the datasources using the TMDB API.
+    """
 
     config_schema = TmdbDatasourceSchema()
 
-    URL_SEARCH = (u'http://api.themoviedb.org/3/search/movie'
-                   '?api_key=%(api_key)s&query=%(query)s')
-    URL_GET = u'http://api.themoviedb.org/3/movie/%(id)s?api_key=%(api_key)s'
-    URL_CAST = u'http://api.themoviedb.org/3/movie/%(id)s/casts?api_key=%(api_key)s'
-    URL_ALT = u'http://api.themoviedb.org/3/movie/%(id)s/alternative_titles?api_key=%(api_key)s'
+    URL_SEARCH = None
+    URL_CHANGES = None
+    CACHE_TTLS = {}
+
+    # Field of movies storing their TMDB id:
+    ID_FIELD = None
+
+    def __init__(self, *args, **kwargs):
+        super(BaseTmdbDatasource, self).__init__(*args, **kwargs)
+        self._memo = {}  # Documents fetched during this run, see _memoized
+        self._memo_lock = threading.Lock()
+        if self.config.get('changes_feed'):
+            self.changes_feed = LocalChangesFeed(self.config.get('changes_feed'))
+        else:
+            self.changes_feed = TmdbChangesFeed(self)
 
     def _tmdb_search(self, title):
         ak = self.config.get('api_key')
         url = self.URL_SEARCH % dict(api_key=ak, query=requests.utils.quote(title.encode('utf8')))
-        response = requests_session.get(url.encode('utf8'))
+        response = cached_get(self, url.encode('utf8'), self.CACHE_TTLS[self.URL_SEARCH])
+        if not response.ok:
+            raise KolektoRuntimeError('Unable to search on TMDB, %s' % response_error(response))
         return json.loads(response.text)
 
     def _get(self, url, *args, **kwargs):
         ak = self.config.get('api_key')
+        raise_on_404 = kwargs.pop('raise_on_404', False)
+        ttl = self.CACHE_TTLS.get(url, ONE_DAY)
         url = url % dict(api_key=ak, **kwargs)
-        for _ in xrange(3):
-            printer.debug('Requesting {url}', url=url)
-            response = requests.get(url)
-            if not response.ok:
-                printer.debug('Got error ({http_err}), retrying in 3s...', http_err=response.status_code)
-                time.sleep(3)
-                continue
-            return json.loads(response.text)
-        else:
-            err_msg = 'Unable to get the URL, server reported error: %s' % response.status_code
-            # Show the error reason message to the user if the requests
-            # version is sufficiently recent:
-            if hasattr(response, 'reason'):
-                err_msg += ' (%s)' % response.reason
-            raise KolektoRuntimeError(err_msg)
+        response = cached_get(self, url, ttl)
+        if raise_on_404 and response.status_code == 404:
+            response.raise_for_status()
+        elif not response.ok:
+            raise KolektoRuntimeError('Unable to get the URL, %s' % response_error(response))
+        return json.loads(response.text)
+
+    def _memoized(self, key, fetch):
+        """ Return the document stored under the key during this run, or
+            fetch it using the `fetch` callable (only once, even if several
+            threads ask for the same key).
+        """
+        with self._memo_lock:
+            entry = self._memo.get(key)
+            if entry is None:
+                entry = self._memo[key] = [threading.Lock(), None]
+        with entry[0]:
+            if entry[1] is None:
+                entry[1] = fetch()
+            return entry[1]
+
+    def _tmdb_changes(self, day):
+        """ Get the set of ids changed on the day (YYYY-MM-DD) from the
+            changes feed, once per run.
+        """
+        return self._memoized(('changes', day), lambda: self.changes_feed.changed_ids(day))
+
+    def is_changed(self, movie, since):
+        if self.ID_FIELD not in movie or datetime.now() - since > CHANGES_MAX_AGE:
+            return None
+        day = since.date()
+        while day <= datetime.now().date():
+            if movie[self.ID_FIELD] in self._tmdb_changes(day.isoformat()):
+                return True
+            day += timedelta(days=1)
+        return False
+
+
+class TmdbDatasource(BaseTmdbDatasource):
+
+    URL_SEARCH = (u'http://api.themoviedb.org/3/search/movie'
+                   '?api_key=%(api_key)s&query=%(query)s')
+    URL_GET = (u'http://api.themoviedb.org/3/movie/%(id)s'
+                '?api_key=%(api_key)s&append_to_response=' + MOVIE_APPENDED)
+    URL_CAST = u'http://api.themoviedb.org/3/movie/%(id)s/casts?api_key=%(api_key)s'
+    URL_CHANGES = (u'http://api.themoviedb.org/3/movie/changes?api_key=%(api_key)s'
+                    '&start_date=%(start)s&end_date=%(end)s&page=%(page)s')
+
+    # Time to live in cache of the responses of each endpoint:
+    CACHE_TTLS = {URL_SEARCH: ONE_DAY,
+                  URL_GET: 7 * ONE_DAY,
+                  URL_CAST: 30 * ONE_DAY,
+                  URL_CHANGES: ONE_DAY / 24}
+
+    ID_FIELD = '_tmdb_id'
 
     def _tmdb_get(self, movie_id):
         return self._get(self.URL_GET, id=movie_id)
@@ -64,124 +195,96 @@ class TmdbDatasource(Datasource):
     def _tmdb_cast(self, movie_id):
         return self._get(self.URL_CAST, id=movie_id)
 
-    def _tmdb_alt(self, movie_id):
-        return self._get(self.URL_ALT, id=movie_id)
+    def _tmdb_directors(self, movie_id):
+        """ Get the directors of a movie, or an empty list if they can't be
+            fetched (they are only used to help the choice of a result).
+        """
+        try:
+            return parse_directors(self._tmdb_cast(movie_id)['crew'])
+        except KolektoRuntimeError as err:
+            printer.debug('Unable to get directors of {id}: {err}', id=movie_id, err=err)
+            return []
 
     def search(self, title, year=None):
         results = self._tmdb_search(title)['results']
         max_results = self.config.get('max_results')
+
+        # Select the results before to fetch their directors concurrently:
+        selected = []
         for result in results:
             # Abort the search if max results is reached:
-            if max_results == 0:
+            if max_results is not None and len(selected) >= max_results:
                 break
 
             # Parse the release year:
-            if result.get('release_date'):
-                movie_year = datetime.strptime(result['release_date'], '%Y-%m-%d').year
-            else:
-                movie_year = None
+            movie_year = parse_year(result.get('release_date'))
 
             # Skip the movie if searched date is not the release date:
             if year is not None and year != movie_year:
                 continue
 
-            # Else, format and yield the movie:
-            cast = self._tmdb_cast(result['id'])
+            selected.append((result, movie_year))
+
+        directors = concurrent_imap(self._tmdb_directors, [r['id'] for r, _ in selected],
+                                    SEARCH_CONCURRENCY)
+        for (result, movie_year), movie_directors in izip(selected, directors):
             movie = self.object_class({'title': result['original_title'],
-                                       'directors': [x['name'] for x in cast['crew'] if x['department'] == 'Directing' and x['job'] == 'Director'],
+                                       'directors': movie_directors,
                                        '_datasource': self.name,
                                        '_tmdb_id': result['id']})
             if movie_year:
                 movie['year'] = movie_year
             yield movie
 
-            if max_results is not None:
-                max_results -= 1
-
     def refresh(self, movie):
         """ Try to refresh metadata of the movie through the datasource.
         """
         if '_tmdb_id' in movie:
-            tmdb_id = movie['_tmdb_id']
-            details = self._tmdb_get(tmdb_id)
-            cast = self._tmdb_cast(tmdb_id)
-            alternatives = self._tmdb_alt(tmdb_id)
-            refreshed = self.object_class({'title': details['original_title'],
-                                           'score': details['popularity'],
-                                           'directors': [x['name'] for x in cast['crew'] if x['department'] == 'Directing' and x['job'] == 'Director'],
-                                           'writers': [x['name'] for x in cast['crew'] if x['department'] == 'Writing'],
-                                           'cast': [x['name'] for x in cast['cast']],
-                                           'genres': [x['name'] for x in details['genres']],
-                                           'countries': [x['name'] for x in details['production_countries']],
-                                           'tmdb_votes': int(round(details.get('vote_average', 0) * 0.5)),
-                                           '_Datasource': self.name,
-                                           '_tmdb_id': tmdb_id})
-            if details.get('release_date'):
-                refreshed['year'] = datetime.strptime(details['release_date'], '%Y-%m-%d').year
-            if details.get('belongs_to_collection'):
-                refreshed['collection'] = details['belongs_to_collection']['name']
-            for alt in alternatives['titles']:
-                refreshed['title_%s' % alt['iso_3166_1'].lower()] = alt['title']
+            refreshed = self.object_class(parse_movie(self._tmdb_get(movie['_tmdb_id'])))
+            refreshed['_Datasource'] = self.name
             return refreshed
 
 
-class TmdbTVSeriesDatasource(Datasource):
-
-    config_schema = TmdbDatasourceSchema()
+class TmdbTVSeriesDatasource(BaseTmdbDatasource):
 
     URL_SEARCH = (u'http://api.themoviedb.org/3/search/tv?api_key=%(api_key)s&query=%(query)s')
-    URL_SERIES = u'http://api.themoviedb.org/3/tv/%(id)s?api_key=%(api_key)s'
+    URL_SERIES = (u'http://api.themoviedb.org/3/tv/%(id)s'
+                   '?api_key=%(api_key)s&append_to_response=' + SERIES_APPENDED)
     URL_SEASON = u'http://api.themoviedb.org/3/tv/%(id)s/season/%(season)s?api_key=%(api_key)s'
     URL_EPISODE = u'http://api.themoviedb.org/3/tv/%(id)s/season/%(season)s/episode/%(ep)s?api_key=%(api_key)s'
-    URL_CREDITS = u'http://api.themoviedb.org/3/tv/%(id)s/season/%(season)s/episode/%(ep)s/credits?api_key=%(api_key)s'
-    URL_ALT = u'http://api.themoviedb.org/3/tv/%(id)s/alternative_titles?api_key=%(api_key)s'
+    URL_EPISODE_CREDITS = URL_EPISODE + '&append_to_response=' + EPISODE_APPENDED
+    URL_CHANGES = (u'http://api.themoviedb.org/3/tv/changes?api_key=%(api_key)s'
+                    '&start_date=%(start)s&end_date=%(end)s&page=%(page)s')
 
-    def _tmdb_search(self, title):
-        ak = self.config.get('api_key')
-        url = self.URL_SEARCH % dict(api_key=ak, query=requests.utils.quote(title.encode('utf8')))
-        response = requests_session.get(url.encode('utf8'))
-        return json.loads(response.text)
+    # Time to live in cache of the responses of each endpoint:
+    CACHE_TTLS = {URL_SEARCH: ONE_DAY,
+                  URL_SERIES: 7 * ONE_DAY,
+                  URL_SEASON: 7 * ONE_DAY,
+                  URL_EPISODE: 30 * ONE_DAY,
+                  URL_EPISODE_CREDITS: 30 * ONE_DAY,
+                  URL_CHANGES: ONE_DAY / 24}
 
-    def _get(self, url, *args, **kwargs):
-        ak = self.config.get('api_key')
-        raise_on_404 = kwargs.pop('raise_on_404', False)
-        url = url % dict(api_key=ak, **kwargs)
-        for _ in xrange(3):
-            printer.debug('Requesting {url}', url=url)
-            response = requests.get(url)
-            if raise_on_404 and response.status_code == 404:
-                response.raise_for_status()
-            elif not response.ok:
-                printer.debug('Got error ({http_err}), retrying in 3s...', http_err=response.status_code)
-                time.sleep(3)
-                continue
-            return json.loads(response.text)
-        else:
-            err_msg = 'Unable to get the URL, server reported error: %s' % response.status_code
-            # Show the error reason message to the user if the requests
-            # version is sufficiently recent:
-            if hasattr(response, 'reason'):
-                err_msg += ' (%s)' % response.reason
-            raise KolektoRuntimeError(err_msg)
+    ID_FIELD = '_tmdbtv_id'
 
     def _tmdb_series(self, tvseries_id):
-        return self._get(self.URL_SERIES, id=tvseries_id)
-
-    def _tmdb_alt_titles(self, tvseries_id):
-        return self._get(self.URL_ALT, id=tvseries_id)
+        """ Get the series with its alternative titles, once per run.
+        """
+        return self._memoized(('series', tvseries_id),
+                              lambda: self._get(self.URL_SERIES, id=tvseries_id))
 
     def _tmdb_season(self, tvseries_id, season):
-        return self._get(self.URL_SEASON, id=tvseries_id, season=season)
+        """ Get the season with its episodes, once per run.
+        """
+        return self._memoized(('season', tvseries_id, season),
+                              lambda: self._get(self.URL_SEASON, id=tvseries_id, season=season))
 
-    def _tmdb_episode(self, tvseries_id, season, episode):
+    def _tmdb_episode(self, tvseries_id, season, episode, credits=False):
+        url = self.URL_EPISODE_CREDITS if credits else self.URL_EPISODE
         try:
-            return self._get(self.URL_EPISODE, raise_on_404=True, id=tvseries_id, season=season, ep=episode)
+            return self._get(url, raise_on_404=True, id=tvseries_id, season=season, ep=episode)
         except requests.HTTPError:
             return None
 
-    def _tmdb_credits(self, tvseries_id, season, episode):
-        return self._get(self.URL_CREDITS, id=tvseries_id, season=season, ep=episode)
-
     def search(self, title, season=None, episode=None):
         results = self._tmdb_search(title)['results']
         max_results = self.config.get('max_results')
@@ -216,29 +319,22 @@ class TmdbTVSeriesDatasource(Datasource):
         if '_tmdbtv_id' in movie:
             refreshed = {'_Datasource': self.name}
             tvseries_id = movie['_tmdbtv_id']
-            series = self._tmdb_series(tvseries_id)
-            alternatives = self._tmdb_alt_titles(tvseries_id)
-            refreshed.update({'title': series['original_name'],
-                              'year': datetime.strptime(series['first_air_date'], '%Y-%m-%d').year,
-                              'genres': [x['name'] for x in series['genres']],
-                              'networks': [x['name'] for x in series['networks']],
-                              'countries': series['origin_country'],
-                              'tmdb_votes': int(round(series.get('vote_average', 0) * 0.5))})
-            for alt in alternatives['results']:
-                refreshed['title_%s' % alt['iso_3166_1'].lower()] = alt['title']
+            refreshed.update(parse_series(self._tmdb_series(tvseries_id)))
             if 'season' in movie:
                 season_num = movie['season']
                 season = self._tmdb_season(tvseries_id, season_num)
-                refreshed.update({'season_title': season['name']})
+                refreshed.update(parse_season(season))
                 if 'episode' in movie:
-                    episode_num = movie['episode']
-                    episode = self._tmdb_episode(tvseries_id, season_num, episode_num)
-                    credits = self._tmdb_credits(tvseries_id, season_num, episode_num)
-                    refreshed.update({'episode_title': episode['name'],
-                                      'directors': [x['name'] for x in credits['crew'] if x['department'] == 'Directing' and x['job'] == 'Director'],
-                                      'writers': [x['name'] for x in credits['crew'] if x['department'] == 'Writing'],
-                                      'cast': [x['name'] for x in credits['cast']],
-                                      'guests': [x['name'] for x in credits['guest_stars']]})
+                    # The cast of the episode is only given by its own details,
+                    # the stored cast is kept when the season describes the
+                    # rest of the episode:
+                    episode = None
+                    if 'cast' in movie:
+                        episode = parse_season_episode(season, movie['episode'])
+                    if episode is None:  # Not described by the season, get the episode
+                        episode = parse_episode(self._tmdb_episode(tvseries_id, season_num,
+                                                                   movie['episode'], credits=True))
+                    refreshed.update(episode)
             return refreshed
 
 
@@ -246,6 +342,8 @@ class TmdbProxyDatasourceSchema(DefaultDatasourceSchema):
 
     base_url = Value(String())
     max_results = Value(Integer(min=1), default=None)
+    timeout = Value(Integer(min=1), default=DEFAULT_TIMEOUT)
+    retries = Value(Integer(min=0), default=DEFAULT_RETRIES)
 
 
 class TmdbProxyDatasource(Datasource):
@@ -253,22 +351,14 @@ class TmdbProxyDatasource(Datasource):
     config_schema = TmdbProxyDatasourceSchema()
 
     def _get(self, uri, *args, **kwargs):
-        url = self.config.get('base_url').rstrip('/') + uri
-        for _ in xrange(3):
-            printer.debug('Requesting {url}', url=url)
-            response = requests_session.get(url, params=kwargs)
-            if not response.ok :
-                printer.debug('Got error ({http_err}), retrying in 3s...', http_err=response.status_code)
-                time.sleep(3)
-                continue
-            return json.loads(response.text)
-        else:
-            err_msg = 'Unable to get the URL, server reported error: %s' % response.status_code
-            # Show the error reason message to the user if the requests
-            # version is sufficiently recent:
-            if hasattr(response, 'reason'):
-                err_msg += ' (%s)' % response.reason
-            raise KolektoRuntimeError(err_msg)
+        base_url = self.config.get('base_url').rstrip('/')
+        client = get_client(('tmdb_proxy', base_url), 'TMDB proxy',
+                            timeout=self.config.get('timeout'),
+                            retries=self.config.get('retries'))
+        response = client.get(base_url + uri, params=kwargs)
+        if not response.ok:
+            raise KolektoRuntimeError('Unable to get the URL, %s' % response_error(response))
+        return json.loads(response.text)
 
     def search(self, title, year=None):
         results = self._get('/1/search', query=title)['movies']
@@ -1,26 +1,790 @@
 import os
+import re
+import json
 import shutil
+import sqlite3
+import threading
+from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+
+import pkg_resources
 
 from kolekto.helpers import JsonDbm
+from kolekto.fastcopy import sample_fingerprint, HASH_ALGORITHMS
+from kolekto.exceptions import KolektoRuntimeError
+
+
+# Format of the import_date field of movies:
+IMPORT_DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+
+# Databases of the .kolekto directory stored using JsonDbm:
+TREE_DATABASES = ('metadata.db', 'facets.db', 'changes.db', 'media-info-cache.db', 'hash-cache.db',
+                  'samples.db', 'imports.db', 'http-cache.db')
+
+# File of the .kolekto directory recording the hash algorithm of the tree:
+HASH_ALGORITHM_FILENAME = 'hash_algorithm'
+
+# Minimum amount of wasted bytes in a database before its auto compaction:
+AUTOCOMPACT_MIN_WASTE = 1024 * 1024
+
+
+def get_tree_hash_algorithm(tree):
+    """ Return the name of the algorithm used to hash the files of the tree.
+
+    Trees created before the algorithm was recorded are hashed with sha1.
+    """
+    try:
+        with open(os.path.join(tree, '.kolekto', HASH_ALGORITHM_FILENAME)) as fhash:
+            return fhash.read().strip()
+    except IOError as err:
+        if err.errno != 2:
+            raise
+        return 'sha1'
+
+
+def set_tree_hash_algorithm(tree, algorithm):
+    """ Record the name of the algorithm used to hash the files of the tree.
+    """
+    if algorithm not in HASH_ALGORITHMS:
+        raise KolektoRuntimeError('Unknown hash algorithm %s' % algorithm)
+    filename = os.path.join(tree, '.kolekto', HASH_ALGORITHM_FILENAME)
+    with open(filename + '.tmp', 'w') as fhash:
+        fhash.write(algorithm + '\n')
+    os.rename(filename + '.tmp', filename)
+
+
+def get_db_backends():
+    """ Return a dict of available metadata database backends by name.
+
+    Backends are registered using the kolekto.db_backends entry-point.
+    """
+    backends = {}
+    for entrypoint in pkg_resources.iter_entry_points('kolekto.db_backends'):
+        backends.setdefault(entrypoint.name, entrypoint)
+    return dict((name, ep.load()) for name, ep in backends.iteritems())
+
+
+def needs_compaction(live, size, threshold):
+    """ Return True if the percentage of wasted space of a database exceeds
+        the threshold (and is big enough to deserve a compaction).
+    """
+    wasted = size - live
+    return bool(threshold) and wasted > AUTOCOMPACT_MIN_WASTE and wasted * 100 > size * threshold
+
+
+def iter_tree_databases(tree):
+    """ Open each existing database of the tree and yield (name, db) couples.
+    """
+    directory = os.path.join(tree, '.kolekto')
+    for name in TREE_DATABASES:
+        filename = os.path.join(directory, name)
+        if os.path.exists(filename):
+            yield name, JsonDbm(filename, object_class=lambda x: x)
+    filename = os.path.join(directory, SqliteMoviesMetadata.filename)
+    if os.path.exists(filename):
+        yield SqliteMoviesMetadata.filename, SqliteMoviesMetadata(filename, indexes=False)
+
+
+def order_key(order):
+    """ Return a sort key function for (hash, movie) couples ordered by
+        the provided list of fields.
+    """
+    def _sorter(item):
+        return tuple(item[1].get(x) for x in order)
+    return _sorter
+
+
+class FacetIndex(JsonDbm):
+
+    """ An inverted index of the list-valued fields (facets) of movies.
+
+    Each value of a facet is stored under a "facet:value" key associated to
+    the list of hashes of the movies having this value, and the "#facet" key
+    stores the number of movies for each value of the facet. The counts
+    changed by updates are written once, when the outermost transaction
+    ends, along with the last changes of the lists of hashes.
+    """
+
+    filename = 'facets.db'
+    FACETS = ('genres', 'directors', 'cast', 'writers', 'countries')
+
+    def __init__(self, filename, sync_interval=None, readonly=False):
+        super(FacetIndex, self).__init__(filename, object_class=lambda x: x,
+                                         sync_interval=sync_interval, readonly=readonly)
+        self._counts = {}
+        self._dirty_counts = set()
+
+    def _key(self, facet, value):
+        return (u'%s:%s' % (facet, value)).encode('utf8')
+
+    def _values(self, movie, facet):
+        if movie is None:
+            return set()
+        values = movie.get(facet) or []
+        if not isinstance(values, list):
+            values = [values]
+        return set(unicode(x) for x in values)
+
+    def _set_count(self, facet, value, count):
+        counts = self.counts(facet)
+        if count:
+            counts[value] = count
+        else:
+            counts.pop(value, None)
+        self._dirty_counts.add(facet)
+
+    @contextmanager
+    def transaction(self, sync_interval=None):
+        with super(FacetIndex, self).transaction(sync_interval):
+            try:
+                yield self
+            finally:
+                if self._transaction_depth == 1:
+                    for facet in self._dirty_counts:
+                        self.save('#' + facet, self._counts[facet])
+                    self._dirty_counts.clear()
+
+    def lookup(self, facet, value):
+        """ Return the set of movie hashes having the value for the facet.
+        """
+        try:
+            return set(str(x) for x in self.get(self._key(facet, value)))
+        except KeyError:
+            return set()
+
+    def counts(self, facet):
+        """ Return a dict of number of movies by value of the facet.
+        """
+        if facet not in self._counts:
+            try:
+                self._counts[facet] = self.get('#' + facet)
+            except KeyError:
+                self._counts[facet] = {}
+        return self._counts[facet]
+
+    def update(self, movie_hash, old, new):
+        """ Update the index of a movie from its old to its new data (any of
+            them can be None for an added or removed movie).
+        """
+        with self.transaction():
+            for facet in self.FACETS:
+                old_values = self._values(old, facet)
+                new_values = self._values(new, facet)
+                for value in old_values - new_values:
+                    hashes = self.lookup(facet, value)
+                    hashes.discard(movie_hash)
+                    if hashes:
+                        self.save(self._key(facet, value), sorted(hashes))
+                    elif self._key(facet, value) in self:
+                        self.remove(self._key(facet, value))
+                    self._set_count(facet, value, len(hashes))
+                for value in new_values - old_values:
+                    hashes = self.lookup(facet, value)
+                    if movie_hash not in hashes:
+                        hashes.add(movie_hash)
+                        self.save(self._key(facet, value), sorted(hashes))
+                        self._set_count(facet, value, len(hashes))
+
+    def rebuild(self, movies):
+        """ Rebuild the whole index from an iterable of (hash, movie) couples.
+        """
+        index = dict((facet, defaultdict(set)) for facet in self.FACETS)
+        for movie_hash, movie in movies:
+            for facet in self.FACETS:
+                for value in self._values(movie, facet):
+                    index[facet][value].add(movie_hash)
+        with self.transaction():
+            for key in list(self.iterkeys()):
+                self.remove(key)
+            for facet, values in index.iteritems():
+                for value, hashes in values.iteritems():
+                    self.save(self._key(facet, value), sorted(hashes))
+                self._counts[facet] = dict((v, len(h)) for v, h in values.iteritems())
+                self._dirty_counts.add(facet)
+
+
+class ChangeLog(JsonDbm):
+
+    """ A log of the changes made on movies, used for incremental dumps.
+
+    Each save or removal of a movie is given a new, monotonically increasing,
+    sequence number. The "h:hash" key stores the last sequence number of a
+    movie and if it has been removed (tombstone), the "s:seq" key stores the
+    hash of the movie changed at this sequence until it changes again, and
+    the "#last" key stores the last sequence number given.
+    """
+
+    filename = 'changes.db'
+
+    def __init__(self, filename, sync_interval=None, readonly=False):
+        super(ChangeLog, self).__init__(filename, object_class=lambda x: x,
+                                        sync_interval=sync_interval, readonly=readonly)
+        try:
+            self._last_seq = self.get('#last')
+        except KeyError:
+            self._last_seq = 0
+        self._dirty = False
+
+    @property
+    def last_seq(self):
+        return self._last_seq
+
+    def sync(self):
+        if self._dirty:
+            self._uncache('#last')
+            self._db['#last'] = self._encode(self._last_seq)
+            self._dirty = False
+        super(ChangeLog, self).sync()
+
+    def record(self, movie_hash, deleted=False):
+        """ Record a change of the movie and return its sequence number.
+        """
+        with self.transaction():
+            try:
+                previous = self.get('h:' + movie_hash)
+            except KeyError:
+                pass
+            else:
+                if 's:%d' % previous['seq'] in self:
+                    self.remove('s:%d' % previous['seq'])
+            self._last_seq += 1
+            self._dirty = True
+            self.save('s:%d' % self._last_seq, movie_hash)
+            self.save('h:' + movie_hash, {'seq': self._last_seq, 'deleted': deleted})
+        return self._last_seq
+
+    def initialize(self, hashes):
+        """ Give a sequence number to each of the provided movie hashes.
+        """
+        with self.transaction():
+            for movie_hash in hashes:
+                self.record(movie_hash)
+
+    def iterchanges(self, since=0):
+        """ Iterate over (seq, hash, deleted) of the last change of each
+            movie changed after the since sequence number.
+        """
+        for seq in xrange(since + 1, self._last_seq + 1):
+            try:
+                movie_hash = str(self.get('s:%d' % seq))
+            except KeyError:
+                continue  # The movie changed again after this sequence
+            yield seq, movie_hash, self.get('h:' + movie_hash)['deleted']
+
+
+class HashCache(JsonDbm):
+
+    """ A persistent cache of the hashes of files.
+
+    Files are identified by their device and inode numbers, and each record
+    stores the size and the modification time of the file when it was hashed,
+    so the record is ignored (and replaced) as soon as the file is modified.
+    The cache can be used concurrently by several threads.
+    """
+
+    filename = 'hash-cache.db'
+
+    def __init__(self, filename, readonly=False):
+        super(HashCache, self).__init__(filename, object_class=lambda x: x, readonly=readonly)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def fingerprint(filename):
+        """ Return a (key, size, mtime_ns) tuple identifying the current
+            version of the file.
+        """
+        st = os.stat(filename)
+        return '%d:%d' % (st.st_dev, st.st_ino), st.st_size, int(st.st_mtime * 1000000000)
+
+    def lookup(self, filename, algorithm='sha1'):
+        """ Return the cached hash of the file, or None if the file has never
+            been hashed or has been modified since.
+        """
+        key, size, mtime_ns = self.fingerprint(filename)
+        with self._lock:
+            if key not in self:
+                return None
+            record = self.get(key)
+        if record['size'] != size or record['mtime_ns'] != mtime_ns:
+            return None
+        return record['hashes'].get(algorithm)
+
+    def store(self, filename, digest, algorithm='sha1', fingerprint=None):
+        """ Store the hash of the file.
+
+        :param fingerprint: the fingerprint of the file taken before hashing
+                            it, the hash is not stored if the file has been
+                            modified since
+        """
+        current = self.fingerprint(filename)
+        if fingerprint is not None and fingerprint != current:
+            return
+        key, size, mtime_ns = current
+        with self._lock:
+            record = self.get(key) if key in self else None
+            if record is None or record['size'] != size or record['mtime_ns'] != mtime_ns:
+                record = {'size': size, 'mtime_ns': mtime_ns, 'hashes': {}}
+            record['hashes'][algorithm] = digest
+            self.save(key, record)
+
+    def hash(self, filename, compute, algorithm='sha1'):
+        """ Return the hash of the file from the cache, or computed by the
+            provided callable (and then stored in the cache).
+        """
+        digest = self.lookup(filename, algorithm)
+        if digest is None:
+            fingerprint = self.fingerprint(filename)
+            digest = compute()
+            self.store(filename, digest, algorithm, fingerprint)
+        return digest
+
+
+class SampleIndex(JsonDbm):
+
+    """ An index of the size and sampled fingerprint (see
+        :func:`kolekto.fastcopy.sample_fingerprint`) of the files stored in
+        the tree, used to find the stored files which may be identical to a
+        file without hashing it.
+
+    The "h:hash" key stores the [size, fingerprint] of a stored file, and the
+    "s:size:fingerprint" key stores the list of hashes of files having this
+    size and fingerprint. The index can be used concurrently by several
+    threads.
+    """
+
+    filename = 'samples.db'
+
+    # Names of files stored in the tree (and not of temporary files):
+    STORED_FILE_RE = re.compile('^[0-9a-f]+$')
+
+    def __init__(self, filename, readonly=False):
+        super(SampleIndex, self).__init__(filename, object_class=lambda x: x, readonly=readonly)
+        self._lock = threading.Lock()
+
+    def candidates(self, size, fingerprint):
+        """ Return the hashes of stored files with this size and fingerprint.
+        """
+        key = 's:%d:%s' % (size, fingerprint)
+        with self._lock:
+            return [str(x) for x in self.get(key)] if key in self else []
+
+    def add(self, filehash, size, fingerprint):
+        key = 's:%d:%s' % (size, fingerprint)
+        with self._lock:
+            hashes = self.get(key) if key in self else []
+            if filehash not in hashes:
+                self.save(key, hashes + [filehash])
+            self.save('h:%s' % filehash, [size, fingerprint])
+
+    def discard(self, filehash):
+        with self._lock:
+            if 'h:%s' % filehash not in self:
+                return
+            size, fingerprint = self.get('h:%s' % filehash)
+            key = 's:%d:%s' % (size, fingerprint)
+            hashes = [x for x in self.get(key) if x != filehash]
+            if hashes:
+                self.save(key, hashes)
+            else:
+                self.remove(key)
+            self.remove('h:%s' % filehash)
+
+    def update_from(self, directory):
+        """ Index the new files stored in the directory and forget the removed
+            ones. Return the number of added and discarded files.
+        """
+        indexed = set(key[2:] for key in self.iterkeys() if key.startswith('h:'))
+        stored = set(x for x in os.listdir(directory) if self.STORED_FILE_RE.match(x))
+        added = 0
+        with self.transaction():
+            for filehash in indexed - stored:
+                self.discard(filehash)
+            for filehash in stored - indexed:
+                filename = os.path.join(directory, filehash)
+                try:
+                    self.add(filehash, os.path.getsize(filename), sample_fingerprint(filename))
+                except (IOError, OSError):
+                    continue  # Broken symlink
+                added += 1
+        return added, len(indexed - stored)
+
+
+class ImportJournal(JsonDbm):
+
+    """ A journal of the copies of files being imported in the tree, used to
+        resume an interrupted copy.
+
+    Records are keyed by the absolute path of the source file and store the
+    fingerprint of the source (see :meth:`HashCache.fingerprint`), the name
+    of the partial file in the movies directory of the tree, and the number of
+    bytes of the partial file safely written to the disk. The journal can be
+    used concurrently by several threads.
+    """
+
+    filename = 'imports.db'
+
+    def __init__(self, filename, readonly=False):
+        super(ImportJournal, self).__init__(filename, object_class=lambda x: x, readonly=readonly)
+        self._movies_directory = os.path.join(os.path.dirname(filename), 'movies')
+        self._lock = threading.Lock()
+
+    def _key(self, source_filename):
+        return os.path.abspath(source_filename).encode('utf8')
+
+    def partial_filename(self, record):
+        return os.path.join(self._movies_directory, record['partial'])
+
+    def begin(self, source_filename, partial_filename):
+        """ Record the start of the copy of the source into the partial file.
+        """
+        with self._lock:
+            self.save(self._key(source_filename),
+                      {'partial': os.path.basename(partial_filename),
+                       'fingerprint': list(HashCache.fingerprint(source_filename)),
+                       'copied': 0})
+
+    def checkpoint(self, source_filename, copied):
+        key = self._key(source_filename)
+        with self._lock:
+            record = self.get(key)
+            record['copied'] = copied
+            self.save(key, record)
+
+    def end(self, source_filename):
+        """ Forget the copy of the source (completed or aborted).
+        """
+        key = self._key(source_filename)
+        with self._lock:
+            if key in self:
+                self.remove(key)
+
+    def is_resumable(self, source_filename, record):
+        """ Return True if the source is unchanged since the copy started and
+            the partial file is still there.
+        """
+        try:
+            fingerprint = list(HashCache.fingerprint(source_filename))
+            partial_size = os.path.getsize(self.partial_filename(record))
+        except OSError:
+            return False
+        return fingerprint == record['fingerprint'] and partial_size >= record['copied']
+
+    def resumable(self, source_filename):
+        """ Return the (partial filename, copied bytes) of the interrupted copy
+            of the source, or None if there is no copy to resume.
+        """
+        key = self._key(source_filename)
+        with self._lock:
+            record = self.get(key) if key in self else None
+        if record is None or not self.is_resumable(source_filename, record):
+            return None
+        return self.partial_filename(record), record['copied']
+
+    def iterpartials(self):
+        """ Iterate over the (source filename, record) of the journaled copies.
+        """
+        for key, record in self.iteritems():
+            yield key.decode('utf8'), record
 
 
 class MoviesMetadata(JsonDbm):
 
     """ A database used to store metadata about movies managed by kolekto.
+
+    The database also maintains a :class:`FacetIndex` and a
+    :class:`ChangeLog` stored next to it, unless `indexes` is False.
+
+    :cvar filename: name of the database file in the .kolekto directory
     """
 
+    filename = 'metadata.db'
+
+    def __init__(self, filename, object_class=dict, sync_interval=None, indexes=True,
+                 **kwargs):
+        super(MoviesMetadata, self).__init__(filename, object_class=object_class,
+                                             sync_interval=sync_interval, **kwargs)
+        self._indexes = indexes
+        self._facets = None
+        self._changes = None
+        if indexes:
+            self._open_indexes(filename, sync_interval)
+
+    def _open_indexes(self, filename, sync_interval):
+        facets_filename = os.path.join(os.path.dirname(filename), FacetIndex.filename)
+        changes_filename = os.path.join(os.path.dirname(filename), ChangeLog.filename)
+        if self._readonly:
+            # Missing indexes can't be built by a reader:
+            if os.path.exists(facets_filename):
+                self._facets = FacetIndex(facets_filename, readonly=True)
+            if os.path.exists(changes_filename):
+                self._changes = ChangeLog(changes_filename, readonly=True)
+        else:
+            build_facets = not os.path.exists(facets_filename)
+            build_changes = not os.path.exists(changes_filename)
+            self._facets = FacetIndex(facets_filename, sync_interval=sync_interval)
+            self._changes = ChangeLog(changes_filename, sync_interval=sync_interval)
+            if build_facets and self.count():
+                self._facets.rebuild(self.iteritems())
+            if build_changes and self.count():
+                self._changes.initialize(self.iterkeys())
+
+    @property
+    def facets(self):
+        if self._facets is None:
+            raise KolektoRuntimeError('The facet index is missing, run kolekto reindex')
+        return self._facets
+
+    @property
+    def changes(self):
+        if self._changes is None:
+            raise KolektoRuntimeError('The change log is missing, run kolekto reindex to create it')
+        return self._changes
+
+    def _store(self, key, data):
+        super(MoviesMetadata, self).save(key, data)
+
+    def _delete(self, key):
+        super(MoviesMetadata, self).remove(key)
+
+    def save(self, key, data):
+        if not self._indexes:
+            return self._store(key, data)
+        try:
+            old = self.get(key)
+        except KeyError:
+            old = None
+        self._store(key, data)
+        self.facets.update(key, old, data)
+        self.changes.record(key)
+
+    def touch(self, key, data):
+        """ Save the movie without updating the indexes, only for changes of
+            internal fields which are neither indexed nor worth a new change
+            sequence (such as the date of the last refresh).
+        """
+        self._store(key, data)
+
+    def remove(self, key):
+        if not self._indexes:
+            return self._delete(key)
+        old = self.get(key)
+        self._delete(key)
+        self.facets.update(key, old, None)
+        self.changes.record(key, deleted=True)
+
+    def close(self):
+        super(MoviesMetadata, self).close()
+        if self._facets is not None:
+            self._facets.close()
+        if self._changes is not None:
+            self._changes.close()
+
+    @contextmanager
+    def transaction(self, sync_interval=None):
+        with super(MoviesMetadata, self).transaction(sync_interval):
+            if not self._indexes:
+                yield self
+            else:
+                with self.facets.transaction(sync_interval), \
+                        self.changes.transaction(sync_interval):
+                    yield self
+
     def itermovieshash(self):
         """ Iterate over movies hash stored in the database.
         """
-        cur = self._db.firstkey()
-        while cur is not None:
-            yield cur
-            cur = self._db.nextkey(cur)
+        return self.iterkeys()
 
-    def itermovies(self):
+    def itermovies(self, order=None):
         """ Iterate over (hash, movie) couple stored in database.
+
+        :param order: list of fields used to sort movies, unordered if None
+        """
+        if order is None:
+            return self.iteritems()
+        else:
+            return iter(sorted(self.iteritems(), key=order_key(order)))
+
+    def iterimported(self, since):
+        """ Iterate over (hash, movie) couple of movies imported since the
+            provided datetime.
+        """
+        for movie_hash, movie in self.iteritems():
+            try:
+                import_date = datetime.strptime(movie.get('import_date'), IMPORT_DATE_FORMAT)
+            except (TypeError, ValueError):
+                continue  # No or bad import date
+            if import_date >= since:
+                yield movie_hash, movie
+
+    def iterchanges(self, since=0):
+        """ Iterate over (seq, hash, movie) of movies changed after the since
+            sequence number, movie is None for removed movies.
+        """
+        for seq, movie_hash, deleted in self.changes.iterchanges(since):
+            try:
+                movie = None if deleted else self.get(movie_hash)
+            except KeyError:
+                movie = None  # Removed while iterating
+            yield seq, movie_hash, movie
+
+    def itermatching(self, facets):
+        """ Iterate over (hash, movie) couple of movies matching all the
+            provided (facet, value) couples, using the facet index.
+        """
+        hashes = None
+        for facet, value in facets:
+            matching = self.facets.lookup(facet, value)
+            hashes = matching if hashes is None else hashes & matching
+        for movie_hash in sorted(hashes or ()):
+            yield movie_hash, self.get(movie_hash)
+
+    def iterduplicates(self, fields=('title', 'year')):
+        """ Iterate over (hash, movie) couple of movies sharing the same
+            values for the provided fields with at least another movie.
+        """
+        hashes_by_key = defaultdict(list)
+        for movie_hash, movie in self.iteritems():
+            hashes_by_key[tuple(movie.get(x) for x in fields)].append(movie_hash)
+        for hashes in hashes_by_key.itervalues():
+            if len(hashes) > 1:
+                for movie_hash in hashes:
+                    yield movie_hash, self.get(movie_hash)
+
+
+class SqliteMoviesMetadata(MoviesMetadata):
+
+    """ A movies metadata database stored in SQLite.
+
+    Movies are stored as a JSON document along with some extracted fields
+    stored in indexed columns, allowing to push filtering and ordering into
+    the database engine.
+    """
+
+    filename = 'metadata.sqlite'
+
+    FLAGS = ('watched', 'favorite', 'crap')
+    INDEXED_COLUMNS = ('title', 'year', 'flags', 'import_date')
+    ORDERABLE_COLUMNS = ('title', 'year')  # Ordered like Python does
+
+    SCHEMA = ('CREATE TABLE IF NOT EXISTS movies (hash TEXT PRIMARY KEY, '
+              'document TEXT NOT NULL, title TEXT, year INTEGER, flags TEXT, '
+              'import_date TEXT)',
+              'CREATE INDEX IF NOT EXISTS movies_title ON movies (title, year)',
+              'CREATE INDEX IF NOT EXISTS movies_year ON movies (year)',
+              'CREATE INDEX IF NOT EXISTS movies_flags ON movies (flags)',
+              'CREATE INDEX IF NOT EXISTS movies_import_date ON movies (import_date)')
+
+    def _open(self, filename):
+        db = sqlite3.connect(filename)
+        db.text_factory = str
+        if self._readonly:
+            db.execute('PRAGMA query_only = ON')
+        else:
+            # The WAL journal allows readers to run concurrently with a writer:
+            db.execute('PRAGMA journal_mode = WAL')
+            for statement in self.SCHEMA:
+                db.execute(statement)
+            db.commit()
+        return db
+
+    def _columns(self, data):
+        """ Extract indexed columns values from movie data.
         """
-        return self.iteritems()
+        flags = ','.join(x for x in self.FLAGS if data.get(x))
+        import_date = data.get('import_date')
+        if import_date:
+            try:
+                import_date = datetime.strptime(import_date, IMPORT_DATE_FORMAT).isoformat(' ')
+            except ValueError:
+                import_date = None
+        return data.get('title'), data.get('year'), flags or None, import_date or None
+
+    def __contains__(self, key):
+        cursor = self._db.execute('SELECT 1 FROM movies WHERE hash = ?', (key,))
+        return cursor.fetchone() is not None
+
+    def _fetch(self, key):
+        cursor = self._db.execute('SELECT document FROM movies WHERE hash = ?', (key,))
+        row = cursor.fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+    def _decode(self, record):
+        return json.loads(record)
+
+    def count(self):
+        return self._db.execute('SELECT COUNT(*) FROM movies').fetchone()[0]
+
+    def _store(self, key, data):
+        self._uncache(key)
+        self._db.execute('INSERT OR REPLACE INTO movies (hash, document, title, '
+                         'year, flags, import_date) VALUES (?, ?, ?, ?, ?, ?)',
+                         (key, json.dumps(data)) + self._columns(data))
+        self._written()
+
+    def _delete(self, key):
+        self._uncache(key)
+        cursor = self._db.execute('DELETE FROM movies WHERE hash = ?', (key,))
+        if not cursor.rowcount:
+            raise KeyError(key)
+        self._written()
+
+    def sync(self):
+        self._db.commit()
+        self._unsynced = 0
+
+    def close(self):
+        if not self._readonly:
+            # Merge the WAL journal into the database file, so the file is
+            # complete by itself once closed:
+            self.sync()
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        super(SqliteMoviesMetadata, self).close()
+
+    def size_report(self):
+        page_size = self._db.execute('PRAGMA page_size').fetchone()[0]
+        page_count = self._db.execute('PRAGMA page_count').fetchone()[0]
+        free_count = self._db.execute('PRAGMA freelist_count').fetchone()[0]
+        return (page_count - free_count) * page_size, os.path.getsize(self._filename)
+
+    def compact(self):
+        self.sync()
+        self._db.execute('VACUUM')
+
+    def iterkeys(self):
+        for row in self._db.execute('SELECT hash FROM movies'):
+            yield row[0]
+
+    def _iterrows(self, query, params=()):
+        for movie_hash, document in self._db.execute(query, params):
+            yield movie_hash, self._object_class(json.loads(document))
+
+    def iteritems(self):
+        return self._iterrows('SELECT hash, document FROM movies')
+
+    def itermovies(self, order=None):
+        if order is not None and not all(x in self.ORDERABLE_COLUMNS for x in order):
+            # Can't be ordered by the engine, fallback on a sort in Python:
+            return super(SqliteMoviesMetadata, self).itermovies(order)
+        query = 'SELECT hash, document FROM movies'
+        if order:
+            query += ' ORDER BY ' + ', '.join(order)
+        return self._iterrows(query)
+
+    def iterimported(self, since):
+        return self._iterrows('SELECT hash, document FROM movies WHERE import_date >= ?',
+                              (since.isoformat(' '),))
+
+    def iterduplicates(self, fields=('title', 'year')):
+        if not all(x in self.INDEXED_COLUMNS for x in fields):
+            return super(SqliteMoviesMetadata, self).iterduplicates(fields)
+        join = ' AND '.join('m.%s IS d.%s' % (x, x) for x in fields)
+        fields = ', '.join(fields)
+        return self._iterrows('SELECT m.hash, m.document FROM movies m JOIN '
+                              '(SELECT %s FROM movies GROUP BY %s HAVING COUNT(*) > 1) d '
+                              'ON %s' % (fields, fields, join))
 
 
 class AttachmentStore(object):
@@ -54,4 +818,4 @@ class AttachmentStore(object):
 
     def exists(self, movie_hash, name):
         attachment_fullname = os.path.join(self.directory, movie_hash, name)
-        return os.path.isfile(attachment_fullname)
+        return os.path.isfile(attachment_fullname)
\ No newline at end of file
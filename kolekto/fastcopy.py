@@ -0,0 +1,475 @@
+""" Copy and hash engine used to import movies in a tree.
+
+Files are read using large buffers and hashed in a separate thread, so the
+hashing of a buffer overlaps the read and the write of the next one (the
+hash functions of hashlib release the GIL on large buffers). When the kernel
+supports it, the copy itself is done by ``copy_file_range`` or ``sendfile``
+without passing data through the userspace, the source being hashed in
+parallel by a second read. This read is served by the page cache when the
+kernel copy is ahead of it, but when the source isn't cached the two reads
+may both hit the disk (up to twice the reads of a buffered copy), use
+``kernel=False`` for such sources on slow disks.
+
+Run ``python -m kolekto.fastcopy FILE`` to benchmark the engine against the
+legacy copy loop (from a cold cache when the kernel allows to drop the
+cached pages of the file).
+"""
+
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import argparse
+import hashlib
+import threading
+import multiprocessing
+from Queue import Queue
+from hashlib import sha1
+from functools import partial
+from tempfile import NamedTemporaryFile
+from multiprocessing.pool import ThreadPool
+
+try:
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number and size of the blocks read to compute the sampled fingerprint:
+SAMPLE_BLOCKS = 8
+SAMPLE_BLOCK_SIZE = 64 * 1024
+
+# Number of bytes copied between two checkpoints of a resumable copy:
+CHECKPOINT_INTERVAL = 256 * 1024 * 1024
+
+# Size of the chunks hashed in parallel by tree hashes:
+TREE_HASH_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Minimum delay between two updates of the progress bar (in seconds):
+PROGRESS_INTERVAL = 0.2
+
+# Number of rounds of the benchmark, the order of the methods being rotated
+# at each round:
+BENCHMARK_ROUNDS = 3
+
+POSIX_FADV_DONTNEED = 4
+
+# Errors meaning the kernel copy is not supported for these files:
+KERNEL_COPY_UNSUPPORTED = (errno.ENOSYS, errno.EINVAL, errno.EXDEV,
+                           errno.EOPNOTSUPP, errno.EBADF, errno.EPERM)
+
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+_copy_file_range = getattr(_libc, 'copy_file_range', None)
+if _copy_file_range is not None:
+    _copy_file_range.restype = ctypes.c_ssize_t
+    _copy_file_range.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                 ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                 ctypes.c_size_t, ctypes.c_uint)
+
+_sendfile = getattr(_libc, 'sendfile64', None)
+if _sendfile is not None:
+    _sendfile.restype = ctypes.c_ssize_t
+    _sendfile.argtypes = (ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t)
+
+_posix_fadvise = getattr(_libc, 'posix_fadvise64', None)
+if _posix_fadvise is not None:
+    _posix_fadvise.restype = ctypes.c_int
+    _posix_fadvise.argtypes = (ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int)
+
+
+_tree_hash_pool = None
+
+
+def _chunk_digest(hash_factory, chunk):
+    return hash_factory(chunk).digest()
+
+
+class TreeHash(object):
+
+    """ A hash of the data computed as the hash of the digests of each chunk
+        of `chunk_size` bytes of the data, the chunks being hashed in
+        parallel by a pool of threads.
+
+    It implements the part of the hashlib interface used by this module.
+    """
+
+    def __init__(self, hash_factory=sha1, chunk_size=TREE_HASH_CHUNK_SIZE):
+        global _tree_hash_pool
+        if _tree_hash_pool is None:
+            _tree_hash_pool = ThreadPool(multiprocessing.cpu_count())
+        self._hash_factory = hash_factory
+        self._chunk_size = chunk_size
+        self._max_pending = 2 * multiprocessing.cpu_count()
+        self._buffer = ''
+        self._digests = []
+        self._pending = []
+
+    def update(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            chunk, self._buffer = self._buffer[:self._chunk_size], self._buffer[self._chunk_size:]
+            self._pending.append(_tree_hash_pool.apply_async(_chunk_digest, (self._hash_factory, chunk)))
+            # Limit the number of chunks kept in memory:
+            while len(self._pending) > self._max_pending:
+                self._digests.append(self._pending.pop(0).get())
+
+    def digest(self):
+        digests = self._digests + [x.get() for x in self._pending]
+        if self._buffer or not digests:
+            digests.append(_chunk_digest(self._hash_factory, self._buffer))
+        return self._hash_factory(''.join(digests)).digest()
+
+    def hexdigest(self):
+        return self.digest().encode('hex')
+
+
+HASH_ALGORITHMS = {'sha1': sha1,
+                   'sha256': hashlib.sha256,
+                   'sha512': hashlib.sha512,
+                   'tree-sha1': partial(TreeHash, sha1),
+                   'tree-sha256': partial(TreeHash, hashlib.sha256)}
+
+if pyblake2 is not None:
+    HASH_ALGORITHMS.update({'blake2b': pyblake2.blake2b,
+                            'tree-blake2b': partial(TreeHash, pyblake2.blake2b)})
+
+
+class ThrottledProgress(object):
+
+    """ Forward the progression to the `update` callback at most once every
+        `interval` seconds.
+    """
+
+    def __init__(self, update, interval=PROGRESS_INTERVAL):
+        self._update = update
+        self._interval = interval
+        self._pending = 0
+        self._last = 0
+
+    def __call__(self, value):
+        self._pending += value
+        now = time.time()
+        if now - self._last >= self._interval:
+            self.flush()
+            self._last = now
+
+    def flush(self):
+        if self._pending and self._update is not None:
+            self._update(self._pending)
+        self._pending = 0
+
+
+class Hasher(threading.Thread):
+
+    """ Hash the buffers pushed with :meth:`feed` in a separate thread.
+
+    The queue only keeps two buffers, so the reader can't get more than two
+    buffers ahead of the hashing (double buffering).
+
+    An error raised by the hashing is stored and raised again by the next
+    call of :meth:`feed` or :meth:`hexdigest`, the thread only discarding the
+    buffers still pushed, so the feeder never blocks on the queue.
+    """
+
+    def __init__(self, hash_factory=sha1, hash_object=None):
+        super(Hasher, self).__init__()
+        self.daemon = True
+        self._hash = hash_factory() if hash_object is None else hash_object
+        self._queue = Queue(maxsize=2)
+        self._error = None
+
+    def run(self):
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                break
+            if self._error is None:
+                try:
+                    self._hash.update(buf)
+                except Exception as err:
+                    self._error = err
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+    def feed(self, buf):
+        self._raise_error()
+        self._queue.put(buf)
+
+    def hexdigest(self):
+        """ Wait for all the buffers to be hashed and return the digest.
+        """
+        self._queue.put(None)
+        self.join()
+        self._raise_error()
+        return self._hash.hexdigest()
+
+
+class FileHasher(Hasher):
+
+    """ Read and hash a whole file (from the `start` offset) in a separate
+        thread.
+    """
+
+    def __init__(self, filename, buffer_size=DEFAULT_BUFFER_SIZE, hash_factory=sha1,
+                 start=0, hash_object=None):
+        super(FileHasher, self).__init__(hash_factory, hash_object)
+        self._filename = filename
+        self._buffer_size = buffer_size
+        self._start = start
+
+    def run(self):
+        try:
+            with open(self._filename, 'rb') as fsource:
+                fsource.seek(self._start)
+                while True:
+                    buf = fsource.read(self._buffer_size)
+                    if not buf:
+                        break
+                    self._hash.update(buf)
+        except Exception as err:
+            self._error = err
+
+    def hexdigest(self):
+        self.join()
+        self._raise_error()
+        return self._hash.hexdigest()
+
+
+def hash_file(filename, buffer_size=DEFAULT_BUFFER_SIZE, update=None, hash_factory=sha1):
+    """ Return the hex digest of the file, hashing a buffer while the next
+        one is read.
+    """
+    progress = ThrottledProgress(update)
+    hasher = Hasher(hash_factory)
+    hasher.start()
+    with open(filename, 'rb') as fsource:
+        while True:
+            buf = fsource.read(buffer_size)
+            if not buf:
+                break
+            hasher.feed(buf)
+            progress(len(buf))
+    digest = hasher.hexdigest()
+    progress.flush()
+    return digest
+
+
+def hash_prefix(filename, length, buffer_size=DEFAULT_BUFFER_SIZE, hash_factory=sha1):
+    """ Return a hash object updated with the first `length` bytes of the
+        file, used to resume a copy (hash states can't be serialized).
+    """
+    hash_object = hash_factory()
+    with open(filename, 'rb') as fsource:
+        while length > 0:
+            buf = fsource.read(min(buffer_size, length))
+            if not buf:
+                raise IOError('%s is shorter than expected' % filename)
+            hash_object.update(buf)
+            length -= len(buf)
+    return hash_object
+
+
+def sample_fingerprint(filename, blocks=SAMPLE_BLOCKS, block_size=SAMPLE_BLOCK_SIZE):
+    """ Return a fingerprint of the file computed from a few blocks evenly
+        spread over it, including the first and the last one.
+
+    Files with different fingerprints are different, files with the same
+    fingerprint and size are probably (but not surely) identical.
+    """
+    size = os.path.getsize(filename)
+    fingerprint = sha1()
+    with open(filename, 'rb') as fsource:
+        if size <= blocks * block_size:
+            fingerprint.update(fsource.read())
+        else:
+            step = (size - block_size) // (blocks - 1)
+            for i in xrange(blocks):
+                fsource.seek(i * step)
+                fingerprint.update(fsource.read(block_size))
+    return fingerprint.hexdigest()
+
+
+def _kernel_copy(fsource, fdestination, start, size, buffer_size, written):
+    """ Copy the source from the `start` offset into destination using the
+        kernel, and return the offset reached (`start` if the kernel copy is
+        not supported for these files).
+    """
+    src_fd, dst_fd = fsource.fileno(), fdestination.fileno()
+    offset = ctypes.c_int64(start)
+    for func in (_copy_file_range, _sendfile):
+        if func is None:
+            continue
+        try:
+            while offset.value < size:
+                count = min(buffer_size, size - offset.value)
+                if func is _copy_file_range:
+                    copied = func(src_fd, ctypes.byref(offset), dst_fd, None, count, 0)
+                else:
+                    copied = func(dst_fd, src_fd, ctypes.byref(offset), count)
+                if copied < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.EINTR:
+                        continue
+                    raise OSError(err, os.strerror(err))
+                elif copied == 0:
+                    break  # Source truncated during the copy
+                written(copied)
+        except OSError as err:
+            # Try the next function if this one is not supported:
+            if offset.value != start or err.errno not in KERNEL_COPY_UNSUPPORTED:
+                raise
+        else:
+            break
+    return offset.value
+
+
+def copy_file(source_filename, fdestination, buffer_size=DEFAULT_BUFFER_SIZE,
+              update=None, kernel=True, hash_factory=sha1, start=0, hash_object=None,
+              checkpoint=None, checkpoint_interval=CHECKPOINT_INTERVAL):
+    """ Copy the source file into the destination file object, and return the
+        hex digest of the source.
+
+    :param update: callback called with the number of bytes copied since the
+                   last call, throttled to avoid slowing down the copy
+    :param kernel: use the kernel copy if available
+    :param start: offset where to resume the copy, the destination must
+                  already contain the source up to this offset
+    :param hash_object: a hash object already updated with the source up to
+                        the `start` offset (see :func:`hash_prefix`)
+    :param checkpoint: callback called every `checkpoint_interval` bytes
+                       with the number of bytes of the destination flushed
+                       to the disk
+    """
+    progress = ThrottledProgress(update)
+    size = os.path.getsize(source_filename)
+    state = {'copied': start, 'checkpoint': start}
+
+    def written(count):
+        progress(count)
+        state['copied'] += count
+        if checkpoint is not None and state['copied'] - state['checkpoint'] >= checkpoint_interval:
+            fdestination.flush()
+            os.fsync(fdestination.fileno())
+            checkpoint(state['copied'])
+            state['checkpoint'] = state['copied']
+
+    with open(source_filename, 'rb') as fsource:
+        fdestination.seek(start)
+        if kernel and size > start and (_copy_file_range or _sendfile):
+            # The source is hashed by a second read while the kernel copy it
+            # (see the module documentation for its cost), the remaining
+            # data (if any) is copied by the loop below:
+            hasher = FileHasher(source_filename, buffer_size, hash_factory, start, hash_object)
+            hasher.start()
+            feed = lambda buf: None
+            fdestination.flush()
+            copied = _kernel_copy(fsource, fdestination, start, size, buffer_size, written)
+        else:
+            hasher = Hasher(hash_factory, hash_object)
+            hasher.start()
+            feed = hasher.feed
+            copied = start
+        fsource.seek(copied)
+        fdestination.seek(copied)
+        while True:
+            buf = fsource.read(buffer_size)
+            if not buf:
+                break
+            feed(buf)
+            fdestination.write(buf)
+            written(len(buf))
+        fdestination.flush()
+    digest = hasher.hexdigest()
+    progress.flush()
+    return digest
+
+
+def legacy_copy(source_filename, fdestination):
+    """ The copy loop used before this engine, kept as benchmark reference.
+    """
+    filehash = sha1()
+    with open(source_filename, 'rb') as fsource:
+        while True:
+            buf = fsource.read(10 * 1024)
+            if not buf:
+                break
+            filehash.update(buf)
+            fdestination.write(buf)
+    return filehash.hexdigest()
+
+
+def drop_cache(filename):
+    """ Ask the kernel to drop the cached pages of the file, return False
+        if it's not supported.
+    """
+    if _posix_fadvise is None:
+        return False
+    with open(filename, 'rb') as fsource:
+        return _posix_fadvise(fsource.fileno(), 0, 0, POSIX_FADV_DONTNEED) == 0
+
+
+def benchmark(filename, directory=None, buffer_size=DEFAULT_BUFFER_SIZE, rounds=BENCHMARK_ROUNDS):
+    """ Copy the file using each method, then hash it using each available
+        algorithm, and yield a (name, MB/s) couple for each of them.
+
+    Each method is run `rounds` times, from a cold cache if possible (see
+    :func:`drop_cache`), rotating the order of the methods at each round so
+    none of them always benefits from the cache warmed by another, and the
+    median speed is reported.
+    """
+    size = os.path.getsize(filename)
+    methods = [('legacy (10 KiB)', lambda fdest: legacy_copy(filename, fdest)),
+               ('buffered + hash thread', lambda fdest: copy_file(filename, fdest, buffer_size, kernel=False)),
+               ('kernel copy + hash thread', lambda fdest: copy_file(filename, fdest, buffer_size))]
+    for name in sorted(HASH_ALGORITHMS):
+        methods.append(('hash %s' % name, partial(lambda hash_factory, fdest: hash_file(
+            filename, buffer_size, hash_factory=hash_factory), HASH_ALGORITHMS[name])))
+    reference = None
+    elapsed = dict((name, []) for name, _ in methods)
+    for round_ in xrange(rounds):
+        shift = round_ % len(methods)
+        for name, method in methods[shift:] + methods[:shift]:
+            drop_cache(filename)
+            with NamedTemporaryFile(dir=directory) as fdestination:
+                started = time.time()
+                digest = method(fdestination)
+                os.fsync(fdestination.fileno())
+                elapsed[name].append(time.time() - started)
+            if name.startswith('hash '):
+                continue
+            if reference is None:
+                reference = digest
+            elif digest != reference:
+                raise RuntimeError('%s produced a bad digest (%s != %s)' % (name, digest, reference))
+    for name, _ in methods:
+        median = sorted(elapsed[name])[len(elapsed[name]) // 2]
+        yield name, size / (1024.0 * 1024.0) / max(median, 1e-6)
+
+
+if __name__ == '__main__':
+    aparser = argparse.ArgumentParser(description='Benchmark the copy engines of Kolekto.')
+    aparser.add_argument('file', help='File to copy (use a big one)')
+    aparser.add_argument('--directory', '-d', help='Directory where to copy the file')
+    aparser.add_argument('--buffer-size', '-b', type=int, default=DEFAULT_BUFFER_SIZE,
+                         help='Buffer size in bytes')
+    aparser.add_argument('--rounds', '-r', type=int, default=BENCHMARK_ROUNDS,
+                         help='Number of runs of each method')
+    args = aparser.parse_args()
+    if not drop_cache(args.file):
+        print 'Warning: the cache of the file can\'t be dropped, speeds are measured from a warm cache'
+    for name, speed in benchmark(args.file, args.directory, args.buffer_size, args.rounds):
+        print '%-30s %8.1f MB/s' % (name, speed)
@@ -4,6 +4,74 @@
 import os
 import gdbm
 import json
+import time
+import errno
+import fcntl
+import zlib
+import marshal
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from kolekto.exceptions import KolektoRuntimeError
+
+
+# Timeout used to wait for results of thread pools, a wait without timeout
+# could not be interrupted by Ctrl-C:
+WAIT_FOREVER = 365 * 24 * 3600
+
+# Records encoded by the compact codec are compressed above this size:
+COMPRESSION_THRESHOLD = 1024
+
+# Version bytes prefixing each record depending of its encoding, records
+# without any version byte are legacy JSON records:
+RECORD_JSON = '\x01'
+RECORD_MARSHAL = '\x02'
+RECORD_MARSHAL_ZLIB = '\x03'
+
+
+def _marshalable(data):
+    # Marshal only supports builtin types, not their subclasses:
+    if isinstance(data, dict) and type(data) is not dict:
+        data = dict(data)
+    return data
+
+
+def encode_json(data):
+    return RECORD_JSON + json.dumps(data)
+
+
+def encode_marshal(data):
+    return RECORD_MARSHAL + marshal.dumps(_marshalable(data))
+
+
+def encode_compact(data):
+    encoded = marshal.dumps(_marshalable(data))
+    if len(encoded) > COMPRESSION_THRESHOLD:
+        return RECORD_MARSHAL_ZLIB + zlib.compress(encoded)
+    else:
+        return RECORD_MARSHAL + encoded
+
+
+CODECS = {'json': encode_json,
+          'marshal': encode_marshal,
+          'compact': encode_compact}
+
+DECODERS = {RECORD_JSON: lambda record: json.loads(record[1:]),
+            RECORD_MARSHAL: lambda record: marshal.loads(record[1:]),
+            RECORD_MARSHAL_ZLIB: lambda record: marshal.loads(zlib.decompress(record[1:]))}
+
+
+def decode_record(record):
+    """ Decode a record encoded by any codec, using its version byte.
+    """
+    decoder = DECODERS.get(record[:1])
+    if decoder is None:
+        return json.loads(record)  # Legacy record
+    else:
+        return decoder(record)
+
 
 def get_hash(input_string):
     """ Return the hash of the movie depending on the input string.
@@ -20,22 +88,202 @@ def get_hash(input_string):
     return input_string.lower()
 
 
+def concurrent_imap(func, items, threads):
+    """ Yield the result of func for each item, in the order of items,
+        calling func in a pool of at most `threads` threads.
+    """
+    items = list(items)
+    if len(items) <= 1 or threads <= 1:
+        for item in items:
+            yield func(item)
+        return
+    pool = ThreadPool(min(len(items), threads))
+    try:
+        results = pool.imap(func, items)
+        for _ in xrange(len(items)):
+            yield results.next(WAIT_FOREVER)
+    finally:
+        pool.terminate()
+
+
+class TokenBucket(object):
+
+    """ A token bucket rate limiter, which can be shared by several threads.
+
+    The bucket is refilled by `rate` tokens per second, up to `capacity`
+    tokens (allowing bursts of `capacity` acquisitions).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = max(1, rate) if capacity is None else capacity
+        self._tokens = self.capacity
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """ Take tokens from the bucket, waiting for them if needed.
+        """
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class FileLock(object):
+
+    """ An exclusive lock on a file, used to serialize writers of a tree.
+
+    The file contains the description of the current owner of the lock, which
+    is reported to other processes failing to acquire it.
+
+    :param timeout: seconds to wait for the lock, None to wait forever
+    """
+
+    def __init__(self, filename, timeout=None, owner=''):
+        self.filename = filename
+        self.timeout = timeout
+        self.owner = owner
+        self._flock = None
+
+    def acquire(self):
+        flock = open(self.filename, 'a+')
+        started = time.time()
+        while True:
+            try:
+                fcntl.flock(flock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if self.timeout is not None and time.time() - started >= self.timeout:
+                    flock.seek(0)
+                    owner = flock.read().strip() or 'unknown'
+                    flock.close()
+                    raise KolektoRuntimeError('The tree is locked by another kolekto '
+                                              'command (%s), retry later' % owner)
+                time.sleep(0.1)
+            else:
+                break
+        flock.truncate(0)
+        flock.write('%s, pid %d' % (self.owner, os.getpid()))
+        flock.flush()
+        self._flock = flock
+
+    def release(self):
+        if self._flock is not None:
+            self._flock.truncate(0)
+            self._flock.close()  # Also release the lock
+            self._flock = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
 class JsonDbm(object):
 
-    """ A simple GNU DBM database which store JSON-serialized Python.
+    """ A simple GNU DBM database which store serialized Python.
+
+    Records are serialized using the codec selected by name in
+    :data:`CODECS` (JSON by default). Each record is prefixed by a version
+    byte identifying its encoding, so records encoded with different codecs
+    can coexist in the same database.
+
+    If `cache_size` is set, the last read records are kept encoded in a LRU
+    cache, so a hit saves the lookup in the database file (a disk read for
+    records not in the page cache) but not the decoding, each :meth:`get`
+    returning a new object callers can modify freely. Hits and misses of the
+    caches are counted by database file name, see :meth:`cache_stats`.
+
+    A `readonly` database is opened without taking the gdbm lock, so it can
+    be opened while another process holds it for writing. gdbm doesn't
+    isolate such readers from the writes: a read racing with a write may see
+    a partially updated database. Writers must be serialized by the caller
+    (see :class:`FileLock`).
+
+    :cvar defaults: default options of databases, see :meth:`configure`
     """
 
-    def __init__(self, filename, object_class=dict):
-        self._db = gdbm.open(filename, 'c')
+    defaults = {'codec': 'json', 'cache_size': 0}
+    _cache_stats = {}
+
+    @classmethod
+    def configure(cls, **options):
+        """ Set the default options of databases opened afterwards.
+        """
+        cls.defaults.update(options)
+
+    @classmethod
+    def cache_stats(cls):
+        """ Return a dict of (hits, misses) couples of the record caches by
+            database file name, for the databases opened with a cache.
+        """
+        return dict((name, tuple(stats)) for name, stats in JsonDbm._cache_stats.iteritems())
+
+    def __init__(self, filename, object_class=dict, sync_interval=None, codec=None,
+                 cache_size=None, readonly=False):
+        self._readonly = readonly
+        self._filename = filename
+        self._db = self._open(filename)
         self._object_class = object_class
+        self._encode = CODECS[codec or self.defaults['codec']]
+        self._sync_interval = sync_interval
+        self._transaction_depth = 0
+        self._unsynced = 0
+        self._cache = OrderedDict()
+        self._cache_size = self.defaults['cache_size'] if cache_size is None else cache_size
+        if self._cache_size:
+            self._stats = JsonDbm._cache_stats.setdefault(os.path.basename(filename), [0, 0])
+
+    def _open(self, filename):
+        return gdbm.open(filename, 'ru' if self._readonly else 'c')
 
     def __contains__(self, key):
         return key in self._db
 
+    def _fetch(self, key):
+        """ Fetch the encoded record associated with provided key.
+        """
+        return self._db[key]
+
+    def _decode(self, record):
+        return decode_record(record)
+
+    def _load(self, key):
+        """ Load and decode the data associated with provided key.
+        """
+        return self._decode(self._fetch(key))
+
     def get(self, key):
         """ Get data associated with provided key.
         """
-        return self._object_class(json.loads(self._db[key]))
+        if not self._cache_size:
+            return self._object_class(self._load(key))
+        try:
+            record = self._cache.pop(key)
+        except KeyError:
+            self._stats[1] += 1
+            record = self._fetch(key)
+            if len(self._cache) >= self._cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._stats[0] += 1
+        self._cache[key] = record
+        return self._object_class(self._decode(record))
+
+    def _uncache(self, key):
+        """ Invalidate the cached record of provided key.
+        """
+        self._cache.pop(key, None)
 
     def count(self):
         """ Count records in the database.
@@ -45,17 +293,120 @@ class JsonDbm(object):
     def save(self, key, data):
         """ Save data associated with key.
         """
-        self._db[key] = json.dumps(data)
-        self._db.sync()
+        self._uncache(key)
+        self._db[key] = self._encode(data)
+        self._written()
 
     def remove(self, key):
         """ Remove the specified key from the database.
         """
+        self._uncache(key)
         del self._db[key]
+        self._written()
+
+    def recode(self):
+        """ Rewrite records which are not encoded with the database codec.
+
+        :return: the number of rewritten records
+        """
+        rewritten = 0
+        with self.transaction():
+            for key in list(self.iterkeys()):
+                record = self._db[key]
+                encoded = self._encode(decode_record(record))
+                if encoded != record:
+                    self._uncache(key)
+                    self._db[key] = encoded
+                    rewritten += 1
+                    self._written()
+        return rewritten
+
+    def sync(self):
+        """ Flush all pending writes to the disk.
+        """
         self._db.sync()
+        self._unsynced = 0
+
+    def _written(self):
+        """ Sync the database after a write, unless a transaction is running.
+
+        Inside a transaction, the database is only synced every
+        `sync_interval` writes (if set) and when the transaction ends.
+        """
+        if not self._transaction_depth:
+            self.sync()
+        else:
+            self._unsynced += 1
+            if self._sync_interval and self._unsynced >= self._sync_interval:
+                self.sync()
+
+    @contextmanager
+    def transaction(self, sync_interval=None):
+        """ Group writes made in the with block and sync them only once.
+
+        Each record is stored by a single gdbm call which can't be interrupted
+        by a signal, and the database is always synced when leaving the block
+        (even on error or Ctrl-C), so an interrupted transaction never leaves
+        a half written file: every record saved before the interruption is
+        flushed, the others are not written at all.
+
+        :param sync_interval: sync every N writes during the transaction,
+                              override the interval given to the constructor
+        """
+        if sync_interval is not None and not self._transaction_depth:
+            previous_interval, self._sync_interval = self._sync_interval, sync_interval
+        else:
+            previous_interval = self._sync_interval
+        self._transaction_depth += 1
+        try:
+            yield self
+        finally:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self._sync_interval = previous_interval
+                self.sync()
+
+    def close(self):
+        """ Close the database.
+        """
+        self._db.close()
+
+    def size_report(self):
+        """ Return a (live, size) couple of the bytes used by the records and
+            the size of the database file.
+        """
+        live = sum(len(key) + len(self._db[key]) for key in self.iterkeys())
+        return live, os.path.getsize(self._filename)
+
+    def compact(self):
+        """ Rewrite the database file without its free space.
+
+        The records are copied in a new file which atomically replaces the
+        database once completely written, so an interrupted compaction leaves
+        the database untouched. This is why ``gdbm.reorganize()`` is not
+        used: its behavior when interrupted depends on the version of the
+        gdbm library.
+        """
+        compact_filename = self._filename + '.compact'
+        compact_db = gdbm.open(compact_filename, 'n')
+        for key in self.iterkeys():
+            compact_db[key] = self._db[key]
+        compact_db.sync()
+        compact_db.close()
+        self._db.close()
+        os.rename(compact_filename, self._filename)
+        self._db = self._open(self._filename)
+
+    def iterkeys(self):
+        """ Iterate over keys stored in database.
+        """
+        cur = self._db.firstkey()
+        while cur is not None:
+            yield cur
+            cur = self._db.nextkey(cur)
 
     def iteritems(self):
         """ Iterate over (key, data) couple stored in database.
         """
-        for key in self.itermovieshash():
+        for key in self.iterkeys():
             yield key, self.get(key)
\ No newline at end of file
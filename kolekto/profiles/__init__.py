@@ -16,6 +16,12 @@ class Profile(object):
                      pkg_resources.iter_entry_points(group='kolekto.commands'),
                      pkg_resources.iter_entry_points(group='kolekto.commands.no_profile'))
 
+    def plan_refresh(self, movies):
+        """ Return the (hash, movie) couples to refresh, in the order they
+            should be refreshed.
+        """
+        return movies
+
     def load_commands(self, parser):
         """ Load commands of this profile.
 
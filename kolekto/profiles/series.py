@@ -9,3 +9,11 @@ class TVSeries(Profile):
     object_class = dict
     list_default_pattern = u'<b>{title}</b> ({year|"unknown"}) season <b>{season}</b> episode <b>{episode}</b>'
     list_default_order = ('title', 'year', 'season', 'episode')
+
+    def plan_refresh(self, movies):
+        """ Group the episodes by series and season, so the documents of
+            each series and season are fetched once and reused while they
+            are refreshed.
+        """
+        return sorted(movies, key=lambda (h, m): (m.get('_tmdbtv_id'), m.get('season'),
+                                                  m.get('episode')))
@@ -0,0 +1,103 @@
+""" Parsing of the TMDB API responses, shared by the TMDB datasources and
+    the TMDB proxy so they produce the same metadata.
+
+The details of movies, series and episodes are requested with their
+sub-resources appended (using the append_to_response parameter of the API),
+so each of them is fetched by a single request.
+"""
+
+from datetime import datetime
+
+
+# Sub-resources appended to the requests of details:
+MOVIE_APPENDED = 'casts,alternative_titles'
+SERIES_APPENDED = 'alternative_titles'
+EPISODE_APPENDED = 'credits'
+
+
+def parse_year(date):
+    """ Return the year of a TMDB date, or None if the date is empty.
+    """
+    if date:
+        return datetime.strptime(date, '%Y-%m-%d').year
+
+
+def parse_directors(crew):
+    return [x['name'] for x in crew if x['department'] == 'Directing' and x['job'] == 'Director']
+
+
+def parse_writers(crew):
+    return [x['name'] for x in crew if x['department'] == 'Writing']
+
+
+def parse_alternative_titles(titles):
+    return dict(('title_%s' % alt['iso_3166_1'].lower(), alt['title']) for alt in titles)
+
+
+def parse_movie(details):
+    """ Return the metadata of a movie from its details requested with the
+        MOVIE_APPENDED sub-resources.
+    """
+    cast = details['casts']
+    movie = {'title': details['original_title'],
+             'score': details['popularity'],
+             'directors': parse_directors(cast['crew']),
+             'writers': parse_writers(cast['crew']),
+             'cast': [x['name'] for x in cast['cast']],
+             'genres': [x['name'] for x in details['genres']],
+             'countries': [x['name'] for x in details['production_countries']],
+             'tmdb_votes': int(round(details.get('vote_average', 0) * 0.5)),
+             '_tmdb_id': details['id']}
+    if details.get('release_date'):
+        movie['year'] = parse_year(details['release_date'])
+    if details.get('belongs_to_collection'):
+        movie['collection'] = details['belongs_to_collection']['name']
+    movie.update(parse_alternative_titles(details['alternative_titles']['titles']))
+    return movie
+
+
+def parse_series(series):
+    """ Return the metadata of a TV series from its details requested with
+        the SERIES_APPENDED sub-resources.
+    """
+    metadata = {'title': series['original_name'],
+                'year': parse_year(series['first_air_date']),
+                'genres': [x['name'] for x in series['genres']],
+                'networks': [x['name'] for x in series['networks']],
+                'countries': series['origin_country'],
+                'tmdb_votes': int(round(series.get('vote_average', 0) * 0.5))}
+    metadata.update(parse_alternative_titles(series['alternative_titles']['results']))
+    return metadata
+
+
+def parse_season(season):
+    return {'season_title': season['name']}
+
+
+def parse_season_episode(season, episode_number):
+    """ Return the metadata of a TV series episode from the details of its
+        season, or None if the episode isn't fully described by the season.
+
+    The result has no cast: the season only gives its regular cast, not the
+    cast of the episode (see :func:`parse_episode`).
+    """
+    for episode in season.get('episodes', ()):
+        if episode['episode_number'] == int(episode_number):
+            if 'crew' not in episode or 'guest_stars' not in episode:
+                return None
+            return {'episode_title': episode['name'],
+                    'directors': parse_directors(episode['crew']),
+                    'writers': parse_writers(episode['crew']),
+                    'guests': [x['name'] for x in episode['guest_stars']]}
+
+
+def parse_episode(episode):
+    """ Return the metadata of a TV series episode from its details requested
+        with the EPISODE_APPENDED sub-resources.
+    """
+    credits = episode['credits']
+    return {'episode_title': episode['name'],
+            'directors': parse_directors(credits['crew']),
+            'writers': parse_writers(credits['crew']),
+            'cast': [x['name'] for x in credits['cast']],
+            'guests': [x['name'] for x in credits['guest_stars']]}
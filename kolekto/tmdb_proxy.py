@@ -3,13 +3,15 @@
 
 import os
 import json
-from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 import requests
 import redis
 
 from flask import Flask, Response, request
 
+from kolekto.tmdb_parsing import MOVIE_APPENDED, parse_year, parse_directors, parse_movie
+
 
 TMDB_API_URL = u'http://api.themoviedb.org/3'
 ONE_WEEK = 604800
@@ -23,6 +25,7 @@ app.config.update(REDIS_HOST=os.environ.get('KOLEKTO_REDIS_HOST', 'localhost'),
                   REDIS_RO_PORT=int(os.environ.get('KOLEKTO_REDIS_RO_PORT', 6379)),
                   TMDB_API_KEY=os.environ['KOLEKTO_TMDB_API_KEY'],
                   CACHE_TTL=int(os.environ.get('KOLEKTO_CACHE_TTL', ONE_WEEK)),
+                  SEARCH_CONCURRENCY=int(os.environ.get('KOLEKTO_SEARCH_CONCURRENCY', 8)),
                   DEBUG=os.environ.get('KOLEKTO_DEBUG') == 'on')
 
 redis_conn = redis.StrictRedis(host=app.config['REDIS_HOST'],
@@ -46,6 +49,18 @@ def get_on_tmdb(uri, **kwargs):
     return json.loads(response.text)
 
 
+def get_casts_on_tmdb(movie_ids):
+    """ Get the casts of several movies on TMDB concurrently.
+    """
+    if not movie_ids:
+        return []
+    pool = ThreadPool(min(len(movie_ids), app.config['SEARCH_CONCURRENCY']))
+    try:
+        return pool.map(lambda movie_id: get_on_tmdb(u'/movie/%s/casts' % movie_id), movie_ids)
+    finally:
+        pool.terminate()
+
+
 @app.route('/1/search')
 def search():
     """ Search a movie on TMDB.
@@ -57,13 +72,12 @@ def search():
     else:
         try:
             found = get_on_tmdb(u'/search/movie', query=request.args['query'])
+            casts = get_casts_on_tmdb([movie['id'] for movie in found['results']])
             movies = []
-            for movie in found['results']:
-                cast = get_on_tmdb(u'/movie/%s/casts' % movie['id'])
-                year = datetime.strptime(movie['release_date'], '%Y-%m-%d').year if movie['release_date'] else None
+            for movie, cast in zip(found['results'], casts):
                 movies.append({'title': movie['original_title'],
-                               'directors': [x['name'] for x in cast['crew'] if x['department'] == 'Directing' and x['job'] == 'Director'],
-                               'year': year,
+                               'directors': parse_directors(cast['crew']),
+                               'year': parse_year(movie['release_date']),
                                '_tmdb_id': movie['id']})
         except requests.HTTPError as err:
             return Response('TMDB API error: %s' % str(err), status=err.response.status_code)
@@ -82,26 +96,10 @@ def get_movie(tmdb_id):
         return Response(cached)
     else:
         try:
-            details = get_on_tmdb(u'/movie/%d' % tmdb_id)
-            cast = get_on_tmdb(u'/movie/%d/casts' % tmdb_id)
-            alternative = get_on_tmdb(u'/movie/%d/alternative_titles' % tmdb_id)
+            details = get_on_tmdb(u'/movie/%d' % tmdb_id, append_to_response=MOVIE_APPENDED)
         except requests.HTTPError as err:
             return Response('TMDB API error: %s' % str(err), status=err.response.status_code)
-        movie = {'title': details['original_title'],
-                 'score': details['popularity'],
-                 'directors': [x['name'] for x in cast['crew'] if x['department'] == 'Directing' and x['job'] == 'Director'],
-                 'writers': [x['name'] for x in cast['crew'] if x['department'] == 'Writing'],
-                 'cast': [x['name'] for x in cast['cast']],
-                 'genres': [x['name'] for x in details['genres']],
-                 'countries': [x['name'] for x in details['production_countries']],
-                 'tmdb_votes': int(round(details.get('vote_average', 0) * 0.5)),
-                 '_tmdb_id': tmdb_id}
-        if details.get('release_date'):
-            movie['year'] = datetime.strptime(details['release_date'], '%Y-%m-%d').year
-        if details.get('belongs_to_collection'):
-            movie['collection'] = details['belongs_to_collection']['name']
-        for alt in alternative['titles']:
-            movie['title_%s' % alt['iso_3166_1'].lower()] = alt['title']
+        movie = parse_movie(details)
         json_response = json.dumps({'movie': movie})
         redis_conn.setex(redis_key, app.config['CACHE_TTL'], json_response)
         return Response(json_response)
@@ -34,7 +34,11 @@ setup(name='kolekto',
                                          'crap = kolekto.commands.flags:Crap',
                                          'edit = kolekto.commands.edit:Edit',
                                          'webexport = kolekto.commands.webexport:WebExport',
-                                         'list = kolekto.commands.list:List'],
+                                         'list = kolekto.commands.list:List',
+                                         'migrate-db = kolekto.commands.migrate_db:MigrateDb',
+                                         'reindex = kolekto.commands.reindex:Reindex',
+                                         'compact = kolekto.commands.compact:Compact',
+                                         'rehash = kolekto.commands.rehash:Rehash'],
                     'kolekto.commands.no_profile': ['init = kolekto.commands.init:Init'],
                     'kolekto.commands.movies': ['import = kolekto.commands.importer:ImportMovies',
                                                 'stats = kolekto.commands.stats:Stats',
@@ -45,6 +49,9 @@ setup(name='kolekto',
                                             'tmdb_proxy = kolekto.datasources.tmdb:TmdbProxyDatasource',
                                             'mediainfos = kolekto.datasources.mediainfos:MediainfosDatasource',
                                             'rewrite = kolekto.datasources.rewrite:RewriteDatasource'],
+                    'kolekto.db_backends': ['gdbm = kolekto.db:MoviesMetadata',
+                                            'sqlite = kolekto.db:SqliteMoviesMetadata'],
                     'kolekto.profiles': ['movies = kolekto.profiles.movies:Movies',
                                          'tvseries = kolekto.profiles.series:TVSeries']},
-      install_requires=['confiture', 'kaa-metadata', 'progressbar', 'requests', 'lxml'])
+      install_requires=['confiture', 'kaa-metadata', 'progressbar', 'requests', 'lxml'],
+      extras_require={'blake2': ['pyblake2']})
@@ -0,0 +1,105 @@
+""" Tests of the refresh command driven by the changes feed of datasources.
+"""
+
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from kolekto.printer import printer
+from kolekto.profiles import Profile
+from kolekto.db import MoviesMetadata, IMPORT_DATE_FORMAT
+from kolekto.commands import refresh
+from kolekto.datasources import Datasource, MovieDatasource, REFRESH_DATE_FIELD
+from kolekto.datasources.tmdb import TmdbDatasource
+
+
+class FakeConfig(object):
+
+    def subsections(self, name):
+        return []
+
+
+class FakeTmdbDatasource(TmdbDatasource):
+
+    """ A TMDB datasource using a local changes feed and refreshing movies
+        without requesting the API.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(FakeTmdbDatasource, self).__init__(*args, **kwargs)
+        self.refreshed = []
+
+    def refresh(self, movie):
+        self.refreshed.append(movie['_tmdb_id'])
+        return {'title': 'Refreshed %d' % movie['_tmdb_id']}
+
+
+class UnknownDatasource(Datasource):
+
+    def is_changed(self, movie, since):
+        return None
+
+
+class RefreshChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tree = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tree, '.kolekto'))
+        now = datetime.now()
+        self.refresh_date = (now - timedelta(days=2)).strftime(IMPORT_DATE_FORMAT)
+        mdb = MoviesMetadata(os.path.join(self.tree, '.kolekto', MoviesMetadata.filename))
+        for movie_id in (1, 2):
+            mdb.save('%040x' % movie_id, {'title': 'Movie %d' % movie_id, '_tmdb_id': movie_id,
+                                          REFRESH_DATE_FIELD: self.refresh_date})
+        mdb.close()
+
+        # Only the movie 2 changed since its last refresh:
+        self.feed = os.path.join(self.tree, 'changes.json')
+        with open(self.feed, 'w') as ffeed:
+            json.dump({(now - timedelta(days=1)).date().isoformat(): [2, 3]}, ffeed)
+        self.datasource = FakeTmdbDatasource('tmdb', self.tree, {'api_key': 'key', 'changes_feed': self.feed})
+
+        self._orig_ask = printer.ask
+        self._orig_movie_datasource = refresh.MovieDatasource
+        printer.ask = lambda question, default=False: True
+
+    def tearDown(self):
+        printer.ask = self._orig_ask
+        refresh.MovieDatasource = self._orig_movie_datasource
+        shutil.rmtree(self.tree)
+
+    def _run(self, datasources):
+        mds = MovieDatasource([], self.tree)
+        mds._datasources = datasources
+        refresh.MovieDatasource = lambda *args, **kwargs: mds
+        aparser = argparse.ArgumentParser()
+        command = refresh.Refresh('refresh', Profile('movies', None), aparser.add_subparsers())
+        command.prepare()
+        args = aparser.parse_args(['refresh', '--changes'])
+        args.tree = self.tree
+        command.run(args, FakeConfig())
+        mdb = MoviesMetadata(os.path.join(self.tree, '.kolekto', MoviesMetadata.filename))
+        try:
+            return dict(mdb.itermovies())
+        finally:
+            mdb.close()
+
+    def test_changed_movies_only(self):
+        movies = self._run([self.datasource])
+        self.assertEqual(self.datasource.refreshed, [2])
+        self.assertEqual(movies['%040x' % 1]['title'], 'Movie 1')
+        self.assertNotEqual(movies['%040x' % 1][REFRESH_DATE_FIELD], self.refresh_date)
+        self.assertEqual(movies['%040x' % 2]['title'], 'Refreshed 2')
+
+    def test_unknown_is_changed(self):
+        unknown = UnknownDatasource('unknown', self.tree, {})
+        self._run([self.datasource, unknown])
+        self.assertEqual(sorted(self.datasource.refreshed), [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()